@@ -156,16 +156,87 @@ def _load_python_alfcrypto():
     import aescbc
 
     class Pukall_Cipher(object):
+        # The key words mixed in for each byte are the original ones XORed
+        # with 257 * (XOR of all the earlier plaintext bytes), so a key only
+        # has 256 possible rounds. Everything in a round except the running
+        # sum2 chain is worked out once per key and kept here.
+        tables = {}
+
         def __init__(self):
             self.key = None
 
+        def getTables(self, key):
+            table = self.tables.get(key)
+            if table is None:
+                wkey = [ord(key[i*2])<<8 | ord(key[i*2+1]) for i in xrange(8)]
+                table = []
+                for kb in xrange(256):
+                    keyXorVal = kb * 257
+                    temp1 = 0
+                    byteXorVal = 0
+                    sums = []
+                    for j in xrange(8):
+                        temp1 ^= wkey[j] ^ keyXorVal
+                        sums.append((temp1*346)&0xFFFF)
+                        temp1 = (temp1*20021+1)&0xFFFF
+                        byteXorVal ^= temp1
+                    # first and last sum1 of the round, the temp1 part of
+                    # byteXorVal, then the constant added at each sum2 step
+                    table.append((sums[0], sums[7], byteXorVal) +
+                                 tuple([j*20021 + sums[j-1] + sums[j] for j in xrange(1, 8)]))
+                if len(self.tables) >= 16:
+                    self.tables.clear()
+                self.tables[key] = table
+            return table
+
         def PC1(self, key, src, decryption=True):
-            sum1 = 0;
-            sum2 = 0;
-            keyXorVal = 0;
             if len(key)!=16:
                 print "Bad key length!"
                 return None
+            self.key = key
+            if len(src) < 256:
+                # not worth building the tables
+                return self.PC1Short(key, src, decryption)
+            table = self.getTables(key)
+            sum1 = 0
+            sum2 = 0
+            kb = 0
+            dst = bytearray()
+            append = dst.append
+            for curByte in bytearray(src):
+                first, nextSum1, byteXorVal, c1, c2, c3, c4, c5, c6, c7 = table[kb]
+                # the eight sum2 steps of the round
+                s = (sum2*20021 + sum1 + first)&0xFFFF
+                byteXorVal ^= s
+                s = (s*20021 + c1)&0xFFFF
+                byteXorVal ^= s
+                s = (s*20021 + c2)&0xFFFF
+                byteXorVal ^= s
+                s = (s*20021 + c3)&0xFFFF
+                byteXorVal ^= s
+                s = (s*20021 + c4)&0xFFFF
+                byteXorVal ^= s
+                s = (s*20021 + c5)&0xFFFF
+                byteXorVal ^= s
+                s = (s*20021 + c6)&0xFFFF
+                byteXorVal ^= s
+                sum2 = (s*20021 + c7)&0xFFFF
+                byteXorVal ^= sum2
+                sum1 = nextSum1
+                if decryption:
+                    curByte = (curByte ^ (byteXorVal >> 8) ^ byteXorVal) & 0xFF
+                    kb ^= curByte
+                else:
+                    kb ^= curByte
+                    curByte = (curByte ^ (byteXorVal >> 8) ^ byteXorVal) & 0xFF
+                append(curByte)
+            return str(dst)
+
+        # straightforward version, used for short strings such as keys
+        def PC1Short(self, key, src, decryption=True):
+            sum1 = 0;
+            sum2 = 0;
+            keyXorVal = 0;
             wkey = []
             for i in xrange(8):
                 wkey.append(ord(key[i*2])<<8 | ord(key[i*2+1]))
@@ -288,3 +359,30 @@ class KeyIVGen(object):
         return T[0: keylen]
 
 
+# compare the native and pure python Pukall ciphers on book sized records
+def benchmark(size=4096, count=64):
+    import time
+    key = os.urandom(16)
+    records = [os.urandom(size) for i in xrange(count)]
+    results = []
+    for loader in (_load_libalfcrypto, _load_python_alfcrypto):
+        try:
+            pc1 = loader()[1]()
+        except Exception, e:
+            print "%s: not available (%s)" % (loader.__name__, e)
+            continue
+        start = time.time()
+        output = [pc1.PC1(key, rec) for rec in records]
+        elapsed = max(time.time() - start, 1e-6)
+        results.append(output)
+        print "%s: %.2f ms per %d byte record, %.0f KB/s" % (loader.__name__,
+            elapsed * 1000 / count, size, size * count / 1024.0 / elapsed)
+    if len(results) == 2 and results[0] != results[1]:
+        print "Error: native and python ciphers disagree"
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(benchmark())
+
+
@@ -16,6 +16,9 @@ sys.stdout=Unbuffered(sys.stdout)
 import csv
 import os
 import getopt
+import itertools
+import zlib
+from array import array
 from struct import pack
 from struct import unpack
 
@@ -33,15 +36,26 @@ if inCalibre :
     from calibre_plugins.k4mobidedrm import flatxml2html
     from calibre_plugins.k4mobidedrm import flatxml2svg
     from calibre_plugins.k4mobidedrm import stylexml2css
+    from calibre_plugins.k4mobidedrm import topazrecords
 else :
     import convert2xml
     import flatxml2html
     import flatxml2svg
     import stylexml2css
+    import topazrecords
 
 # global switch
 buildXML = False
 
+# books with fewer pages than this are always rendered serially
+PARALLEL_MIN_PAGES = 16
+# number of pages handed to a worker process at a time
+PARALLEL_BATCH = 4
+
+# bytes of page flat xml kept in memory for the svg pass, the rest is
+# spilled to a cache file in the book directory. None keeps it all.
+flatXMLBudget = 64 * 1024 * 1024
+
 # Get a 7 bit encoded number from a file
 def readEncodedNumber(file):
     flag = False
@@ -81,76 +95,27 @@ def readString(file):
         return ""
     return unpack(str(stringLength)+"s",sv)[0]
 
-def getMetaArray(metaFile):
-    # parse the meta file
+def getMetaArray(metaFile, data=None):
+    # parse the meta file (or its contents passed in data)
     result = {}
-    fo = file(metaFile,'rb')
-    size = readEncodedNumber(fo)
+    if data is None:
+        data = file(metaFile,'rb').read()
+    data = bytearray(data)
+    size, pos = convert2xml.decodeNumber(data, 0)
     for i in xrange(size):
-        tag = readString(fo)
-        value = readString(fo)
+        tag, pos = convert2xml.decodeString(data, pos)
+        value, pos = convert2xml.decodeString(data, pos)
         result[tag] = value
         # print tag, value
-    fo.close()
     return result
 
 
-# dictionary of all text strings by index value
-class Dictionary(object):
-    def __init__(self, dictFile):
-        self.filename = dictFile
-        self.size = 0
-        self.fo = file(dictFile,'rb')
-        self.stable = []
-        self.size = readEncodedNumber(self.fo)
-        for i in xrange(self.size):
-            self.stable.append(self.escapestr(readString(self.fo)))
-        self.pos = 0
-    def escapestr(self, str):
-        str = str.replace('&','&amp;')
-        str = str.replace('<','&lt;')
-        str = str.replace('>','&gt;')
-        str = str.replace('=','&#61;')
-        return str
-    def lookup(self,val):
-        if ((val >= 0) and (val < self.size)) :
-            self.pos = val
-            return self.stable[self.pos]
-        else:
-            print "Error - %d outside of string table limits" % val
-            raise TpzDRMError('outside or string table limits')
-            # sys.exit(-1)
-    def getSize(self):
-        return self.size
-    def getPos(self):
-        return self.pos
-
-
 class PageDimParser(object):
     def __init__(self, flatxml):
-        self.flatdoc = flatxml.split('\n')
+        self.doc = convert2xml.getFlatDoc(flatxml)
     # find tag if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
-        result = None
-        docList = self.flatdoc
-        cnt = len(docList)
-        if end == -1 :
-            end = cnt
-        else:
-            end = min(cnt,end)
-        foundat = -1
-        for j in xrange(pos, end):
-            item = docList[j]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=')
-            else :
-                name = item
-                argres = ''
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
-        return foundat, result
+        return self.doc.find(tagpath, pos, end)
     def process(self):
         (pos, sph) = self.findinDoc('page.h',0,-1)
         (pos, spw) = self.findinDoc('page.w',0,-1)
@@ -166,7 +131,7 @@ def getPageDim(flatxml):
 
 class GParser(object):
     def __init__(self, flatxml):
-        self.flatdoc = flatxml.split('\n')
+        self.doc = convert2xml.getFlatDoc(flatxml)
         self.dpi = 1440
         self.gh = self.getData('info.glyph.h')
         self.gw = self.getData('info.glyph.w')
@@ -189,23 +154,12 @@ class GParser(object):
             self.gvtx.append(len(self.vx))
         elif self.gvtx :
             self.gvtx.append(0)
+    # the lists returned are extended above, so hand out copies
     def getData(self, path):
         result = None
-        cnt = len(self.flatdoc)
-        for j in xrange(cnt):
-            item = self.flatdoc[j]
-            if item.find('=') >= 0:
-                (name, argt) = item.split('=')
-                argres = argt.split('|')
-            else:
-                name = item
-                argres = []
-            if (name == path):
-                result = argres
-                break
-        if (len(argres) > 0) :
-            for j in xrange(0,len(argres)):
-                argres[j] = int(argres[j])
+        pos = self.doc.findExact(path)
+        if pos >= 0:
+            result = list(self.doc.getNumbers(pos))
         return result
     def getGlyphDim(self, gly):
         if self.gdpi[gly] == 0:
@@ -214,9 +168,11 @@ class GParser(object):
         maxw = (self.gw[gly] * self.dpi) / self.gdpi[gly]
         return maxh, maxw
     def getPath(self, gly):
-        path = ''
         if (gly < 0) or (gly >= self.count):
-            return path
+            return ''
+        path = []
+        dpi = self.dpi
+        gdpi = self.gdpi[gly]
         tx = self.vx[self.gvtx[gly]:self.gvtx[gly+1]]
         ty = self.vy[self.gvtx[gly]:self.gvtx[gly+1]]
         p = 0
@@ -232,67 +188,207 @@ class GParser(object):
             while ( j  < len(zx) ):
                 if (j == 0):
                     # Start Position.
-                    path += 'M %d %d ' % (zx[j] * self.dpi / self.gdpi[gly], zy[j] * self.dpi / self.gdpi[gly])
+                    path.append('M %d %d ' % (zx[j] * dpi / gdpi, zy[j] * dpi / gdpi))
                 elif (j <= len(zx)-3):
                     # Cubic Bezier Curve
-                    path += 'C %d %d %d %d %d %d ' % (zx[j] * self.dpi / self.gdpi[gly], zy[j] * self.dpi / self.gdpi[gly], zx[j+1] * self.dpi / self.gdpi[gly], zy[j+1] * self.dpi / self.gdpi[gly], zx[j+2] * self.dpi / self.gdpi[gly], zy[j+2] * self.dpi / self.gdpi[gly])
+                    path.append('C %d %d %d %d %d %d ' % (zx[j] * dpi / gdpi, zy[j] * dpi / gdpi, zx[j+1] * dpi / gdpi, zy[j+1] * dpi / gdpi, zx[j+2] * dpi / gdpi, zy[j+2] * dpi / gdpi))
                     j += 2
                 elif (j == len(zx)-2):
                     # Cubic Bezier Curve to Start Position
-                    path += 'C %d %d %d %d %d %d ' % (zx[j] * self.dpi / self.gdpi[gly], zy[j] * self.dpi / self.gdpi[gly], zx[j+1] * self.dpi / self.gdpi[gly], zy[j+1] * self.dpi / self.gdpi[gly], zx[0] * self.dpi / self.gdpi[gly], zy[0] * self.dpi / self.gdpi[gly])
+                    path.append('C %d %d %d %d %d %d ' % (zx[j] * dpi / gdpi, zy[j] * dpi / gdpi, zx[j+1] * dpi / gdpi, zy[j+1] * dpi / gdpi, zx[0] * dpi / gdpi, zy[0] * dpi / gdpi))
                     j += 1
                 elif (j == len(zx)-1):
                     # Quadratic Bezier Curve to Start Position
-                    path += 'Q %d %d %d %d ' % (zx[j] * self.dpi / self.gdpi[gly], zy[j] * self.dpi / self.gdpi[gly], zx[0] * self.dpi / self.gdpi[gly], zy[0] * self.dpi / self.gdpi[gly])
+                    path.append('Q %d %d %d %d ' % (zx[j] * dpi / gdpi, zy[j] * dpi / gdpi, zx[0] * dpi / gdpi, zy[0] * dpi / gdpi))
 
                 j += 1
-        path += 'z'
-        return path
+        path.append('z')
+        return ''.join(path)
+
 
 
+# svg <path> definition of glyph val
+def glyphDefinition(val, path, width, height):
+    return '<path id="gl%d" d="%s" fill="black" /><!-- width=%d height=%d -->\n' % (val, path, width, height)
 
-# dictionary of all text strings by index value
+# all glyphs of the book by integer glyph id
 class GlyphDict(object):
     def __init__(self):
-        self.gdict = {}
-    def lookup(self, id):
-        # id='id="gl%d"' % val
-        if id in self.gdict:
-            return self.gdict[id]
+        # path data, width and height of each glyph, the path is None
+        # for ids without a glyph
+        self.paths = []
+        self.widths = array('l')
+        self.heights = array('l')
+        # <path> definitions built so far
+        self.defs = {}
+    def lookup(self, val):
+        path = self.defs.get(val)
+        if path is None:
+            if (val < 0) or (val >= len(self.paths)) or (self.paths[val] is None):
+                return None
+            path = glyphDefinition(val, self.paths[val], self.widths[val], self.heights[val])
+            self.defs[val] = path
+        return path
+    # width and height of the glyph
+    def getSize(self, val):
+        return self.widths[val], self.heights[val]
+    def addGlyph(self, val, path, width, height):
+        if val >= len(self.paths):
+            n = val + 1 - len(self.paths)
+            self.paths.extend([None] * n)
+            self.widths.extend([0] * n)
+            self.heights.extend([0] * n)
+        self.paths[val] = path
+        self.widths[val] = width
+        self.heights[val] = height
+        self.defs.pop(val, None)
+
+
+# Flat xml of the pages, kept for the svg pass. Pages are held in memory
+# while they fit in budget bytes, later ones are compressed into a cache
+# file in spilldir.
+class FlatXMLCache(object):
+    def __init__(self, spilldir, budget):
+        self.filename = os.path.join(spilldir, 'flatxml.cache')
+        self.budget = budget
+        self.used = 0
+        # the flat xml, or (offset, length) in the cache file
+        self.pages = []
+        self.spill = None
+    def append(self, flat_xml):
+        if (self.budget is None) or (self.used + len(flat_xml) <= self.budget):
+            self.used += len(flat_xml)
+            self.pages.append(flat_xml)
+            return
+        if self.spill is None:
+            self.spill = open(self.filename, 'w+b')
+        data = zlib.compress(flat_xml, 1)
+        self.spill.seek(0, 2)
+        self.pages.append((self.spill.tell(), len(data)))
+        self.spill.write(data)
+    def get(self, index):
+        page = self.pages[index]
+        if isinstance(page, tuple):
+            self.spill.seek(page[0])
+            page = zlib.decompress(self.spill.read(page[1]))
+        return page
+    def getSpilled(self):
+        return len([page for page in self.pages if isinstance(page, tuple)])
+    def close(self):
+        self.pages = []
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+            os.remove(self.filename)
+
+# peak resident memory of this process and of its largest finished child
+# process in MB, None where the platform does not tell
+def peakMemory():
+    try:
+        import resource
+    except ImportError:
         return None
-    def addGlyph(self, val, path):
-        id='id="gl%d"' % val
-        self.gdict[id] = path
-
-
-def generateBook(bookDir, raw, fixedimage):
+    peaks = []
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        peak = resource.getrusage(who).ru_maxrss
+        # reported in bytes on Mac OS X, in KB elsewhere
+        if sys.platform == 'darwin':
+            peak = peak / 1024
+        peaks.append(peak / 1024.0)
+    return peaks
+
+def reportMemory(phase):
+    peaks = peakMemory()
+    if peaks is None:
+        return
+    if peaks[1] > 0:
+        print '   Peak memory after %s: %.1f MB (worker processes %.1f MB)' % (phase, peaks[0], peaks[1])
+    else:
+        print '   Peak memory after %s: %.1f MB' % (phase, peaks[0])
+
+
+# read-only state shared by the page renderers below: the dictionary,
+# glyphs, css classes and output settings of the book being generated
+pageState = None
+
+def initPageWorker(state):
+    global pageState
+    pageState = state
+
+# Convert one page record to flat xml and html. Pages do not depend on
+# each other, so this can run in a worker process.
+def renderPage(args):
+    filename, data = args
+    dict, gd, classlst, meta_array, bookDir, svgDir, xmlDir, raw, fixedimage, scaledpi = pageState
+    flat_xml = convert2xml.fromData(dict, filename, data)
+    if xmlDir is not None:
+        xname = os.path.join(xmlDir, filename.replace('.dat','.xml'))
+        file(xname, 'wb').write(convert2xml.getXML(dict, filename, data))
+    pagehtml, tocinfo = flatxml2html.convert2HTML(flat_xml, classlst, filename, bookDir, gd, fixedimage)
+    return flat_xml, pagehtml, tocinfo
+
+# Convert the flat xml of one book page, possibly made up of several
+# page records, to svg.
+def renderSVGPage(args):
+    pageid, previd, nextid, flat_svg = args
+    dict, gd, classlst, meta_array, bookDir, svgDir, xmlDir, raw, fixedimage, scaledpi = pageState
+    return flatxml2svg.convert2SVG(gd, flat_svg, pageid, previd, nextid, svgDir, raw, meta_array, scaledpi)
+
+# Yield func(task) for each task in order. With jobs > 1 and at least
+# PARALLEL_MIN_PAGES tasks the calls are made by a pool of worker
+# processes, each set up with its own copy of state.
+def renderInOrder(func, tasks, count, jobs, state):
+    if jobs < 2 or count < PARALLEL_MIN_PAGES:
+        initPageWorker(state)
+        try:
+            for task in tasks:
+                yield func(task)
+        finally:
+            initPageWorker(None)
+        return
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs, initPageWorker, (state,))
+    # the pool takes in all the tasks it is given at once, so hand them
+    # over a window at a time to keep them from piling up in memory
+    tasks = iter(tasks)
+    window = jobs * PARALLEL_BATCH * 4
+    try:
+        while True:
+            chunk = list(itertools.islice(tasks, window))
+            if len(chunk) == 0:
+                break
+            for result in pool.imap(func, chunk, PARALLEL_BATCH):
+                yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+# records holds the decrypted Topaz records, if not given they are read
+# from the files extracted into bookDir. The generated book is written
+# to bookDir. jobs > 1 renders the pages with that many worker processes,
+# but only for books with at least PARALLEL_MIN_PAGES pages.
+def generateBook(bookDir, raw, fixedimage, records=None, jobs=1):
     # sanity check Topaz file extraction
     if not os.path.exists(bookDir) :
         print "Can not find directory with unencrypted book"
         return 1
 
-    dictFile = os.path.join(bookDir,'dict0000.dat')
-    if not os.path.exists(dictFile) :
-        print "Can not find dict0000.dat file"
-        return 1
-
-    pageDir = os.path.join(bookDir,'page')
-    if not os.path.exists(pageDir) :
-        print "Can not find page directory in unencrypted book"
-        return 1
+    if records is None:
+        records = topazrecords.TopazRecords(bookDir)
 
-    imgDir = os.path.join(bookDir,'img')
-    if not os.path.exists(imgDir) :
-        print "Can not find image directory in unencrypted book"
+    if not records.hasRecord('dict', 0) :
+        print "Can not find dict0000.dat file"
         return 1
 
-    glyphsDir = os.path.join(bookDir,'glyphs')
-    if not os.path.exists(glyphsDir) :
-        print "Can not find glyphs directory in unencrypted book"
+    if records.getCount('page') == 0 :
+        print "Can not find pages in unencrypted book"
         return 1
 
-    metaFile = os.path.join(bookDir,'metadata0000.dat')
-    if not os.path.exists(metaFile) :
+    if not records.hasRecord('metadata', 0) :
         print "Can not find metadata0000.dat in unencrypted book"
         return 1
 
@@ -300,44 +396,38 @@ def generateBook(bookDir, raw, fixedimage):
     if not os.path.exists(svgDir) :
         os.makedirs(svgDir)
 
+    # svg images of fixed regions are written here
+    imgDir = os.path.join(bookDir,'img')
+    if not os.path.exists(imgDir) :
+        os.makedirs(imgDir)
+
+    xmlDir = None
     if buildXML:
         xmlDir = os.path.join(bookDir,'xml')
         if not os.path.exists(xmlDir) :
             os.makedirs(xmlDir)
 
-    otherFile = os.path.join(bookDir,'other0000.dat')
-    if not os.path.exists(otherFile) :
+    if not records.hasRecord('other', 0) :
         print "Can not find other0000.dat in unencrypted book"
         return 1
 
     print "Updating to color images if available"
-    spath = os.path.join(bookDir,'color_img')
-    dpath = os.path.join(bookDir,'img')
-    filenames = os.listdir(spath)
-    filenames = sorted(filenames)
-    for filename in filenames:
-        imgname = filename.replace('color','img')
-        sfile = os.path.join(spath,filename)
-        dfile = os.path.join(dpath,imgname)
-        imgdata = file(sfile,'rb').read()
-        file(dfile,'wb').write(imgdata)
+    for index in records.getIndices('color'):
+        records.linkRecord('img', index, 'color')
 
     print "Creating cover.jpg"
     isCover = False
-    cpath = os.path.join(bookDir,'img')
-    cpath = os.path.join(cpath,'img0000.jpg')
-    if os.path.isfile(cpath):
-        cover = file(cpath, 'rb').read()
+    if records.hasRecord('img', 0):
         cpath = os.path.join(bookDir,'cover.jpg')
-        file(cpath, 'wb').write(cover)
+        records.exportRecord('img', 0, cpath)
         isCover = True
 
 
     print 'Processing Dictionary'
-    dict = Dictionary(dictFile)
+    dict = convert2xml.Dictionary(records.getFileName('dict', 0), records.getRecord('dict', 0))
 
     print 'Processing Meta Data and creating OPF'
-    meta_array = getMetaArray(metaFile)
+    meta_array = getMetaArray(records.getFileName('metadata', 0), records.getRecord('metadata', 0))
 
     # replace special chars in title and authors like & < >
     title = meta_array.get('Title','No Title Provided')
@@ -371,8 +461,7 @@ def generateBook(bookDir, raw, fixedimage):
 
     # also get the size of a normal text page
     # get the total number of pages unpacked as a safety check
-    filenames = os.listdir(pageDir)
-    numfiles = len(filenames)
+    numfiles = records.getCount('page')
 
     spage = '1'
     if 'firstTextPage' in meta_array:
@@ -385,9 +474,8 @@ def generateBook(bookDir, raw, fixedimage):
     # print "first normal text page is", spage
 
     # get page height and width from first text page for use in stylesheet scaling
-    pname = 'page%04d.dat' % (pnum + 1)
-    fname = os.path.join(pageDir,pname)
-    flat_xml = convert2xml.fromData(dict, fname)
+    pname = records.getFileName('page', pnum + 1)
+    flat_xml = convert2xml.fromData(dict, pname, records.getRecord('page', pnum + 1))
 
     (ph, pw) = getPageDim(flat_xml)
     if (ph == '-1') or (ph == '0') : ph = '11000'
@@ -401,14 +489,16 @@ def generateBook(bookDir, raw, fixedimage):
     # this map is needed because some pages actually are made up of multiple
     # pageXXXX.xml files
     xname = os.path.join(bookDir, 'style.css')
-    flat_xml = convert2xml.fromData(dict, otherFile)
+    otherFile = records.getFileName('other', 0)
+    otherData = records.getRecord('other', 0)
+    # parse it once for both the page id map and the css
+    flat_xml = convert2xml.getFlatDoc(convert2xml.fromData(dict, otherFile, otherData))
 
     # extract info.original.pid to get original page information
     pageIDMap = {}
     pageidnums = stylexml2css.getpageIDMap(flat_xml)
     if len(pageidnums) == 0:
-        filenames = os.listdir(pageDir)
-        numfiles = len(filenames)
+        numfiles = records.getCount('page')
         for k in range(numfiles):
             pageidnums.append(k)
     # create a map from page ids to list of page file nums to process for that page
@@ -424,12 +514,10 @@ def generateBook(bookDir, raw, fixedimage):
     file(xname, 'wb').write(cssstr)
     if buildXML:
         xname = os.path.join(xmlDir, 'other0000.xml')
-        file(xname, 'wb').write(convert2xml.getXML(dict, otherFile))
+        file(xname, 'wb').write(convert2xml.getXML(dict, otherFile, otherData))
 
     print 'Processing Glyphs'
     gd = GlyphDict()
-    filenames = os.listdir(glyphsDir)
-    filenames = sorted(filenames)
     glyfname = os.path.join(svgDir,'glyphs.svg')
     glyfile = open(glyfname, 'w')
     glyfile.write('<?xml version="1.0" standalone="no"?>\n')
@@ -438,33 +526,35 @@ def generateBook(bookDir, raw, fixedimage):
     glyfile.write('<title>Glyphs for %s</title>\n' % meta_array['Title'])
     glyfile.write('<defs>\n')
     counter = 0
-    for filename in filenames:
+    for index in records.getIndices('glyphs'):
+        filename = records.getFileName('glyphs', index)
         # print '     ', filename
         print '.',
-        fname = os.path.join(glyphsDir,filename)
-        flat_xml = convert2xml.fromData(dict, fname)
+        data = records.getRecord('glyphs', index)
+        flat_xml = convert2xml.fromData(dict, filename, data)
 
         if buildXML:
             xname = os.path.join(xmlDir, filename.replace('.dat','.xml'))
-            file(xname, 'wb').write(convert2xml.getXML(dict, fname))
+            file(xname, 'wb').write(convert2xml.getXML(dict, filename, data))
 
         gp = GParser(flat_xml)
         for i in xrange(0, gp.count):
             path = gp.getPath(i)
             maxh, maxw = gp.getGlyphDim(i)
-            fullpath = '<path id="gl%d" d="%s" fill="black" /><!-- width=%d height=%d -->\n' % (counter * 256 + i, path, maxw, maxh)
-            glyfile.write(fullpath)
-            gd.addGlyph(counter * 256 + i, fullpath)
+            glyfile.write(glyphDefinition(counter * 256 + i, path, maxw, maxh))
+            gd.addGlyph(counter * 256 + i, path, maxw, maxh)
         counter += 1
     glyfile.write('</defs>\n')
     glyfile.write('</svg>\n')
     glyfile.close()
     print " "
+    reportMemory('glyphs')
 
 
-    # start up the html
+    # start up the html, the pages are written out as they are done
     # also build up tocentries while processing html
     htmlFileName = "book.html"
+    htmlfile = file(os.path.join(bookDir, htmlFileName), 'wb')
     hlst = []
     hlst.append('<?xml version="1.0" encoding="utf-8"?>\n')
     hlst.append('<!DOCTYPE HTML PUBLIC "-//W3C//DTD XHTML 1.1 Strict//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11-strict.dtd">\n')
@@ -480,44 +570,37 @@ def generateBook(bookDir, raw, fixedimage):
         hlst.append('<meta name="GUID" content="' + meta_array['GUID'] + '" />\n')
     hlst.append('<link href="style.css" rel="stylesheet" type="text/css" />\n')
     hlst.append('</head>\n<body>\n')
+    htmlfile.write("".join(hlst))
+    hlst = None
 
     print 'Processing Pages'
     # Books are at 1440 DPI.  This is rendering at twice that size for
     # readability when rendering to the screen.
     scaledpi = 1440.0
 
-    filenames = os.listdir(pageDir)
-    filenames = sorted(filenames)
-    numfiles = len(filenames)
-
-    xmllst = []
+    xmllst = FlatXMLCache(bookDir, flatXMLBudget)
     elst = []
 
-    for filename in filenames:
-        # print '     ', filename
-        print ".",
-        fname = os.path.join(pageDir,filename)
-        flat_xml = convert2xml.fromData(dict, fname)
+    # everything the page renderers need, handed to each worker process
+    state = (dict, gd, classlst, meta_array, bookDir, svgDir, xmlDir, raw, fixedimage, scaledpi)
 
+    indices = records.getIndices('page')
+    pages = ((records.getFileName('page', index), records.getRecord('page', index)) for index in indices)
+    for flat_xml, pagehtml, tocinfo in renderInOrder(renderPage, pages, len(indices), jobs, state):
+        print ".",
         # keep flat_xml for later svg processing
         xmllst.append(flat_xml)
-
-        if buildXML:
-            xname = os.path.join(xmlDir, filename.replace('.dat','.xml'))
-            file(xname, 'wb').write(convert2xml.getXML(dict, fname))
-
-        # first get the html
-        pagehtml, tocinfo = flatxml2html.convert2HTML(flat_xml, classlst, fname, bookDir, gd, fixedimage)
         elst.append(tocinfo)
-        hlst.append(pagehtml)
+        htmlfile.write(pagehtml)
 
-    # finish up the html string and output it
-    hlst.append('</body>\n</html>\n')
-    htmlstr = "".join(hlst)
-    hlst = None
-    file(os.path.join(bookDir, htmlFileName), 'wb').write(htmlstr)
+    # finish up the html
+    htmlfile.write('</body>\n</html>\n')
+    htmlfile.close()
 
     print " "
+    if xmllst.getSpilled() > 0:
+        print '   Flat xml of %d pages kept on disk' % xmllst.getSpilled()
+    reportMemory('pages')
     print 'Extracting Table of Contents from Amazon OCR'
 
     # first create a table of contents file for the svg images
@@ -586,6 +669,8 @@ def generateBook(bookDir, raw, fixedimage):
     idlst = sorted(pageIDMap.keys())
     numids = len(idlst)
     cnt = len(idlst)
+    # svg pages as (pageid, previd, nextid)
+    svgids = []
     previd = None
     for j in range(cnt):
         pageid = idlst[j]
@@ -593,21 +678,24 @@ def generateBook(bookDir, raw, fixedimage):
             nextid = idlst[j+1]
         else:
             nextid = None
+        svgids.append((pageid, previd, nextid))
+        previd = pageid
+
+    # the flat xml of each svg page is put together from its page
+    # records only when the page is rendered
+    svgpages = ((pageid, previd, nextid, "".join([xmllst.get(page) for page in pageIDMap[pageid]])) for (pageid, previd, nextid) in svgids)
+    # the pages come back in the order of svgids, the generator is run to
+    # its end so that the worker pool is closed
+    svgid = iter(svgids)
+    for svgxml in renderInOrder(renderSVGPage, svgpages, cnt, jobs, state):
+        (pageid, previd, nextid) = svgid.next()
         print '.',
-        pagelst = pageIDMap[pageid]
-        flst = []
-        for page in pagelst:
-            flst.append(xmllst[page])
-        flat_svg = "".join(flst)
-        flst=None
-        svgxml = flatxml2svg.convert2SVG(gd, flat_svg, pageid, previd, nextid, svgDir, raw, meta_array, scaledpi)
         if (raw) :
             pfile = open(os.path.join(svgDir,'page%04d.svg' % pageid),'w')
             slst.append('<a href="svg/page%04d.svg">Page %d</a>\n' % (pageid, pageid))
         else :
             pfile = open(os.path.join(svgDir,'page%04d.xhtml' % pageid), 'w')
             slst.append('<a href="svg/page%04d.xhtml">Page %d</a>\n' % (pageid, pageid))
-        previd = pageid
         pfile.write(svgxml)
         pfile.close()
         counter += 1
@@ -617,8 +705,10 @@ def generateBook(bookDir, raw, fixedimage):
     svgindex = "".join(slst)
     slst = None
     file(os.path.join(bookDir, 'index_svg.xhtml'), 'wb').write(svgindex)
+    xmllst.close()
 
     print " "
+    reportMemory('svg pages')
 
     # build the opf file
     opfname = os.path.join(bookDir, 'book.opf')
@@ -643,9 +733,10 @@ def generateBook(bookDir, raw, fixedimage):
     olst.append('<manifest>\n')
     olst.append('   <item id="book" href="book.html" media-type="application/xhtml+xml"/>\n')
     olst.append('   <item id="stylesheet" href="style.css" media-type="text/css"/>\n')
-    # adding image files to manifest
-    filenames = os.listdir(imgDir)
-    filenames = sorted(filenames)
+    # adding image files to manifest, both the image records and the
+    # svg images generated for fixed regions
+    filenames = [records.getFileName('img', index) for index in records.getIndices('img')]
+    filenames = sorted(set(filenames + os.listdir(imgDir)))
     for filename in filenames:
         imgname, imgext = os.path.splitext(filename)
         if imgext == '.jpg':
@@ -674,22 +765,24 @@ def generateBook(bookDir, raw, fixedimage):
 def usage():
     print "genbook.py generates a book from the extract Topaz Files"
     print "Usage:"
-    print "    genbook.py [-r] [-h [--fixed-image] <bookDir>  "
+    print "    genbook.py [-r] [-h [--fixed-image] [--budget <MB>] <bookDir>  "
     print "  "
     print "Options:"
     print "  -h            :  help - print this usage message"
     print "  -r            :  generate raw svg files (not wrapped in xhtml)"
     print "  --fixed-image :  genearate any Fixed Area as an svg image in the html"
+    print "  --budget      :  MB of page flat xml to keep in memory, the rest goes to disk"
     print "  "
 
 
 def main(argv):
+    global flatXMLBudget
     bookDir = ''
     if len(argv) == 0:
         argv = sys.argv
 
     try:
-        opts, args = getopt.getopt(argv[1:], "rh:",["fixed-image"])
+        opts, args = getopt.getopt(argv[1:], "rh:",["fixed-image", "budget="])
 
     except getopt.GetoptError, err:
         print str(err)
@@ -710,6 +803,12 @@ def main(argv):
             raw = 1
         if o =="--fixed-image":
             fixedimage = True
+        if o =="--budget":
+            try:
+                flatXMLBudget = int(a) * 1024 * 1024
+            except ValueError:
+                print "Invalid parameter for --budget"
+                return 1
 
     bookDir = args[0]
 
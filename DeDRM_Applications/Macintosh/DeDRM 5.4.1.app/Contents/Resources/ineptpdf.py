@@ -49,7 +49,11 @@ import re
 import zlib
 import struct
 import hashlib
+import mmap
+import time
+import getopt
 from itertools import chain, islice
+from collections import deque
 import xml.etree.ElementTree as etree
 import Tkinter
 import Tkconstants
@@ -355,6 +359,18 @@ GEN_XREF_STM = 1
 # This is the value for the current document
 gen_xref_stm = False # will be set in PDFSerializer
 
+# Resolved objects are cached up to about this many bytes, stream data
+# counts by its length and every object adds OBJ_CACHE_COST
+OBJ_CACHE_SIZE = 16 * 1024 * 1024
+OBJ_CACHE_COST = 256
+
+# Number of object streams whose parsed objects are cached
+OBJSTM_CACHE_COUNT = 8
+
+# Tokenize the whole input at once, through a memory map for files,
+# instead of reading it in BUFSIZ chunks
+MMAP_TOKENIZER = True
+
 # PDF parsing routines from pdfminer, with changes for EBX_HANDLER
 
 #  Utilities
@@ -499,16 +515,49 @@ END_KEYWORD = re.compile(r'[#/%\[\]()<>{}\s]')
 END_STRING = re.compile(r'[()\134]')
 OCT_STRING = re.compile(r'[0-7]')
 ESC_STRING = { 'b':8, 't':9, 'n':10, 'f':12, 'r':13, '(':40, ')':41, '\\':92 }
+# The tokens the whole buffer tokenizer reads with one match, the ones
+# it does not match (escaped strings and names, tokens cut short by the
+# end of the data) are left to the parse_* state machine
+TOKEN = re.compile(r'''\s*(?:
+    (?P<comment>%[^\r\n]*)
+  | /(?P<literal>[^#/%\[\]()<>{}\s]*)
+  | (?P<number>[-+0-9][0-9]*(?:\.[0-9]*)?|\.[0-9]*)
+  | (?P<keyword>[A-Za-z][^#/%\[\]()<>{}\s]*)
+  | \((?P<string>[^()\\]*)\)
+  | <(?P<hexstring>[\s0-9a-fA-F]+)
+  | (?P<dictbegin><<)
+  | (?P<dictend>>>)
+  | (?P<wopen><)
+  | (?P<wclose>>)
+  | (?P<other>[^\s%/\-+0-9.A-Za-z(<>])
+)''', re.VERBOSE)
+# the token kinds whose group leaves out the character they start with
+TOKEN_PREFIXED = ('literal', 'string', 'hexstring')
+
+# The whole contents of fp as one buffer: the string of a StringIO or a
+# read only memory map of a file. None if fp cannot be mapped.
+def whole_buffer(fp):
+    if hasattr(fp, 'getvalue'):
+        return fp.getvalue()
+    try:
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError, OverflowError):
+        return None
 
 class PSBaseParser(object):
 
     '''
     Most basic PostScript parser that performs only basic tokenization.
+    With MMAP_TOKENIZER the whole input is one buffer, which is never
+    refilled and seeking only moves the position in it.
     '''
     BUFSIZ = 4096
 
     def __init__(self, fp):
         self.fp = fp
+        self.wholebuf = None
+        if MMAP_TOKENIZER:
+            self.wholebuf = whole_buffer(fp)
         self.seek(0)
         return
 
@@ -540,9 +589,14 @@ class PSBaseParser(object):
         '''
         self.fp.seek(pos)
         # reset the status for nextline()
-        self.bufpos = pos
-        self.buf = ''
-        self.charpos = 0
+        if self.wholebuf is not None:
+            self.bufpos = 0
+            self.buf = self.wholebuf
+            self.charpos = pos
+        else:
+            self.bufpos = pos
+            self.buf = ''
+            self.charpos = 0
         # reset the status for nexttoken()
         self.parse1 = self.parse_main
         self.tokens = []
@@ -550,6 +604,8 @@ class PSBaseParser(object):
 
     def fillbuf(self):
         if self.charpos < len(self.buf): return
+        if self.wholebuf is not None:
+            raise PSEOF('Unexpected EOF')
         # fetch next chunk.
         self.bufpos = self.fp.tell()
         self.buf = self.fp.read(self.BUFSIZ)
@@ -735,7 +791,64 @@ class PSBaseParser(object):
         self.add_token(token)
         return (self.parse_main, j)
 
+    # Read the next token from the whole buffer at charpos with one
+    # match, as parse_main and the state it leads to would. Returns False
+    # if the state machine has to read it.
+    def scantoken(self):
+        s = self.buf
+        m = TOKEN.match(s, self.charpos)
+        if not m:
+            return False
+        end = m.end(0)
+        if end >= len(s):
+            return False
+        kind = m.lastgroup
+        token = m.group(kind)
+        self.tokenstart = m.start(kind)
+        if kind in TOKEN_PREFIXED:
+            self.tokenstart -= 1
+        if kind == 'number':
+            if '.' in token:
+                self.add_token(float(token))
+            else:
+                try:
+                    self.add_token(int(token))
+                except ValueError:
+                    pass
+        elif kind == 'literal':
+            if s[end] == '#':
+                return False
+            self.add_token(LIT(token))
+        elif kind == 'keyword':
+            if token == 'true':
+                self.add_token(True)
+            elif token == 'false':
+                self.add_token(False)
+            else:
+                self.add_token(KWD(token))
+        elif kind == 'string':
+            self.add_token(token)
+        elif kind == 'hexstring':
+            token = SPC.sub('', token)
+            if len(token) % 2 == 0:
+                token = token.decode('hex')
+            else:
+                token = HEX_PAIR.sub(lambda m: chr(int(m.group(0), 16)), token)
+            self.add_token(token)
+        elif kind == 'dictbegin':
+            self.add_token(KEYWORD_DICT_BEGIN)
+        elif kind == 'dictend':
+            self.add_token(KEYWORD_DICT_END)
+        elif kind == 'other':
+            self.add_token(KWD(token))
+        self.charpos = end
+        return True
+
     def nexttoken(self):
+        if self.wholebuf is not None:
+            while not self.tokens and self.parse1 == self.parse_main:
+                if not self.scantoken():
+                    break
         while not self.tokens:
             self.fillbuf()
             (self.parse1, self.charpos) = self.parse1(self.buf, self.charpos)
@@ -776,14 +889,20 @@ class PSBaseParser(object):
         Fetches a next line backword. This is used to locate
         the trailers at the end of a file.
         '''
-        self.fp.seek(0, 2)
-        pos = self.fp.tell()
+        if self.wholebuf is not None:
+            pos = len(self.wholebuf)
+        else:
+            self.fp.seek(0, 2)
+            pos = self.fp.tell()
         buf = ''
         while 0 < pos:
             prevpos = pos
             pos = max(0, pos-self.BUFSIZ)
-            self.fp.seek(pos)
-            s = self.fp.read(prevpos-pos)
+            if self.wholebuf is not None:
+                s = self.wholebuf[pos:prevpos]
+            else:
+                self.fp.seek(pos)
+                s = self.fp.read(prevpos-pos)
             if not s: break
             while 1:
                 n = max(s.rfind('\r'), s.rfind('\n'))
@@ -1165,6 +1284,13 @@ class PDFStream(PDFObject):
             data = self.decipher(self.objid, self.genno, data)
         return data
 
+    # drop the stream data once it has been written out
+    def release(self):
+        self.rawdata = None
+        self.data = None
+        self.decdata = None
+        return
+
 
 ##  PDF Exceptions
 ##
@@ -1313,6 +1439,88 @@ class PDFXRefStream(object):
         raise KeyError(objid)
 
 
+##  PDFObjCache
+##
+##  Keeps the most recently used objects up to a total cost, the least
+##  recently used ones are dropped first.
+##
+class PDFObjCache(object):
+
+    def __init__(self, maxcost, cost=None):
+        self.maxcost = maxcost
+        self.cost = cost
+        self.total = 0
+        self.tick = 0
+        # key -> (tick, obj, cost)
+        self.entries = {}
+        # (tick, key) in the order of use, ticks of keys that were
+        # used again since are stale and skipped
+        self.order = deque()
+        return
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        self.touch(key, entry[1], entry[2])
+        return entry[1]
+
+    def put(self, key, obj):
+        self.pop(key)
+        cost = 1
+        if self.cost:
+            cost = self.cost(obj)
+        # an object that would not fit is not cached at all
+        if cost > self.maxcost:
+            return
+        self.touch(key, obj, cost)
+        self.total += cost
+        while self.total > self.maxcost:
+            self.evict()
+        return
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        self.total -= entry[2]
+        return entry[1]
+
+    def touch(self, key, obj, cost):
+        self.tick += 1
+        self.entries[key] = (self.tick, obj, cost)
+        self.order.append((self.tick, key))
+        if len(self.order) > 2 * len(self.entries) + 64:
+            order = [(entry[0], k) for (k, entry) in self.entries.iteritems()]
+            order.sort()
+            self.order = deque(order)
+        return
+
+    def evict(self):
+        while self.order:
+            (tick, key) = self.order.popleft()
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == tick:
+                self.pop(key)
+                return
+        return
+
+# cost of a resolved object in the cache
+def obj_cache_cost(obj):
+    if isinstance(obj, PDFStream):
+        data = obj.rawdata
+        if data is None:
+            data = obj.data or ''
+        return OBJ_CACHE_COST + len(data)
+    return OBJ_CACHE_COST
+
+
 ##  PDFDocument
 ##
 ##  A PDFDocument object represents a PDF document.
@@ -1324,8 +1532,8 @@ class PDFDocument(object):
 
     def __init__(self):
         self.xrefs = []
-        self.objs = {}
-        self.parsed_objs = {}
+        self.objs = PDFObjCache(OBJ_CACHE_SIZE, obj_cache_cost)
+        self.parsed_objs = PDFObjCache(OBJSTM_CACHE_COUNT)
         self.root = None
         self.catalog = None
         self.parser = None
@@ -1622,24 +1830,40 @@ class PDFDocument(object):
 
     KEYWORD_OBJ = PSKeywordTable.intern('obj')
 
+    # getobjpos(objid)
+    #   Locate an object, returns (stmid, index) for an object stored in
+    #   an object stream, (None, pos) for one stored at pos in the file,
+    #   or None if the xrefs do not have it.
+    def getobjpos(self, objid):
+        for xref in self.xrefs:
+            try:
+                return xref.getpos(objid)
+            except KeyError:
+                pass
+        return None
+
+    # release(objid)
+    #   Forget a resolved object, and the objects parsed from it if it is
+    #   an object stream. It is parsed again if it is needed later.
+    def release(self, objid):
+        self.objs.pop(objid)
+        self.parsed_objs.pop(objid)
+        return
+
     def getobj(self, objid):
         if not self.ready:
             raise PDFException('PDFDocument not initialized')
         #assert self.xrefs
         if objid in self.objs:
             genno = 0
-            obj = self.objs[objid]
+            obj = self.objs.get(objid)
         else:
-            for xref in self.xrefs:
-                try:
-                    (stmid, index) = xref.getpos(objid)
-                    break
-                except KeyError:
-                    pass
-            else:
+            pos = self.getobjpos(objid)
+            if pos is None:
                 #if STRICT:
                 #    raise PDFSyntaxError('Cannot locate objid=%r' % objid)
                 return None
+            (stmid, index) = pos
             if stmid:
                 if gen_xref_stm:
                     return PDFObjStmRef(objid, stmid, index)
@@ -1655,9 +1879,8 @@ class PDFDocument(object):
                         raise PDFSyntaxError('N is not defined: %r' % stream)
                     n = 0
 
-                if stmid in self.parsed_objs:
-                    objs = self.parsed_objs[stmid]
-                else:
+                objs = self.parsed_objs.get(stmid)
+                if objs is None:
                     parser = PDFObjStrmParser(stream.get_data(), self)
                     objs = []
                     try:
@@ -1666,7 +1889,7 @@ class PDFDocument(object):
                             objs.append(obj)
                     except PSEOF:
                         pass
-                    self.parsed_objs[stmid] = objs
+                    self.parsed_objs.put(stmid, objs)
                 genno = 0
                 i = n*2+index
                 try:
@@ -1700,7 +1923,7 @@ class PDFDocument(object):
                     obj.set_objid(objid, genno)
                 if self.decipher:
                     obj = decipher_all(self.decipher, objid, genno, obj)
-            self.objs[objid] = obj
+            self.objs.put(objid, obj)
         return obj
 
 
@@ -1937,18 +2160,24 @@ class PDFSerializer(object):
         maxobj = max(objids)
         trailer = dict(self.trailer)
         trailer['Size'] = maxobj + 1
-        for objid in objids:
-            obj = doc.getobj(objid)
-            if isinstance(obj, PDFObjStmRef):
-                xrefs[objid] = obj
-                continue
-            if obj is not None:
-                try:
-                    genno = obj.genno
-                except AttributeError:
-                    genno = 0
-                xrefs[objid] = (self.tell(), genno)
-                self.serialize_indirect(objid, obj)
+        for group in self.getobjgroups():
+            for objid in group:
+                obj = doc.getobj(objid)
+                if isinstance(obj, PDFObjStmRef):
+                    xrefs[objid] = obj
+                    continue
+                if obj is not None:
+                    try:
+                        genno = obj.genno
+                    except AttributeError:
+                        genno = 0
+                    xrefs[objid] = (self.tell(), genno)
+                    self.serialize_indirect(objid, obj)
+                    if isinstance(obj, PDFStream):
+                        obj.release()
+            # the written objects are not needed any more
+            for objid in group:
+                doc.release(objid)
         startxref = self.tell()
 
         if not gen_xref_stm:
@@ -2022,6 +2251,30 @@ class PDFSerializer(object):
             xrefstm = PDFStream(dic, data)
             self.serialize_indirect(maxobj, xrefstm)
             self.write('startxref\n%d\n%%%%EOF' % startxref)
+    # Yield the object ids in lists, in the order the objects are stored
+    # in the input. An object stream comes after the objects stored in
+    # it, so that it is parsed only once and released afterwards.
+    def getobjgroups(self):
+        doc = self.doc
+        direct = []
+        streams = {}
+        for objid in self.objids:
+            (stmid, index) = doc.getobjpos(objid) or (None, 0)
+            if stmid:
+                streams.setdefault(stmid, []).append((index, objid))
+            else:
+                direct.append((index, objid))
+        direct.sort()
+        for (_, objid) in direct:
+            members = streams.pop(objid, [])
+            members.sort()
+            yield [m for (_, m) in members] + [objid]
+        for stmid in sorted(streams):
+            members = streams[stmid]
+            members.sort()
+            yield [m for (_, m) in members]
+        return
+
     def write(self, data):
         self.outf.write(data)
         self.last = data[-1:]
@@ -2218,6 +2471,42 @@ def decryptBook(keypath, inpath, outpath):
     return 0
 
 
+# resolve every object of the book, returns the number of objects
+def resolveObjects(keypath, inpath):
+    with open(inpath, 'rb') as inf:
+        serializer = PDFSerializer(inf, keypath)
+        doc = serializer.doc
+        for objid in serializer.objids:
+            doc.getobj(objid)
+    return len(serializer.objids)
+
+
+def benchmark(keypath, inpath, count=3):
+    global MMAP_TOKENIZER
+    import tempfile
+    fd, outpath = tempfile.mkstemp('.pdf')
+    os.close(fd)
+    tokenizer = MMAP_TOKENIZER
+    try:
+        for MMAP_TOKENIZER in (False, True):
+            start = time.time()
+            for i in xrange(count):
+                nobjs = resolveObjects(keypath, inpath)
+            parsetime = (time.time() - start) / count
+            start = time.time()
+            for i in xrange(count):
+                decryptBook(keypath, inpath, outpath)
+            dumptime = (time.time() - start) / count
+            mode = 'buffered'
+            if MMAP_TOKENIZER:
+                mode = 'mmap'
+            print '%s tokenizer: %d objects resolved in %.2f s, book decrypted in %.2f s' % (mode, nobjs, parsetime, dumptime)
+    finally:
+        MMAP_TOKENIZER = tokenizer
+        os.remove(outpath)
+    return 0
+
+
 def cli_main(argv=sys.argv):
     progname = os.path.basename(argv[0])
     if RSA is None:
@@ -2225,10 +2514,22 @@ def cli_main(argv=sys.argv):
               "separately.  Read the top-of-script comment for details." % \
               (progname,)
         return 1
-    if len(argv) != 4:
+    try:
+        opts, args = getopt.getopt(argv[1:], "", ["benchmark"])
+    except getopt.GetoptError, err:
+        print str(err)
+        opts, args = [], []
+    timeit = False
+    for o, a in opts:
+        if o == "--benchmark":
+            timeit = True
+    if timeit and len(args) == 2:
+        return benchmark(*args)
+    if len(args) != 3:
         print "usage: %s KEYFILE INBOOK OUTBOOK" % (progname,)
+        print "       %s --benchmark KEYFILE INBOOK" % (progname,)
         return 1
-    keypath, inpath, outpath = argv[1:]
+    keypath, inpath, outpath = args
     return decryptBook(keypath, inpath, outpath)
 
 
@@ -191,12 +191,80 @@ def getKindlePid(pidlst, rec209, token, serialnum):
     return pidlst
 
 
+# Local cache of the values decoded from kinfo files, so that a batch run
+# only decodes each file (including its PBKDF2 key derivation) once.
+# Entries are keyed by the SHA-1 of the kinfo file contents. The cache holds
+# account secrets, so it is off unless usePidCache is set, and the file is
+# only readable by its owner.
+
+usePidCache = False
+pidCache = None
+pidCacheHits = 0
+pidCacheMisses = 0
+
+def getPidCachePath():
+    home = os.path.expanduser('~')
+    if sys.platform.startswith('win'):
+        cachedir = os.path.join(os.environ.get('LOCALAPPDATA', home), 'K4MobiDeDRM')
+    elif sys.platform.startswith('darwin'):
+        cachedir = os.path.join(home, 'Library', 'Preferences', 'org.K4MobiDeDRM')
+    else:
+        cachedir = os.path.join(home, '.K4MobiDeDRM')
+    return os.path.join(cachedir, 'kinfocache.txt')
+
+def loadPidCache():
+    global pidCache
+    if pidCache is None:
+        pidCache = {}
+        try:
+            for line in file(getPidCachePath(), 'rb'):
+                fields = line.strip().split(':')
+                if len(fields) == 3:
+                    pidCache[fields[0]] = (binascii.unhexlify(fields[1]), binascii.unhexlify(fields[2]))
+        except (IOError, TypeError):
+            pass
+    return pidCache
+
+def savePidCache():
+    path = getPidCachePath()
+    tmppath = path + '.%d' % os.getpid()
+    try:
+        cachedir = os.path.dirname(path)
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir, 0700)
+        fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        f = os.fdopen(fd, 'wb')
+        for key, (DSN, kindleAccountToken) in pidCache.items():
+            f.write('%s:%s:%s\n' % (key, binascii.hexlify(DSN), binascii.hexlify(kindleAccountToken)))
+        f.close()
+        if sys.platform.startswith('win') and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmppath, path)
+    except (IOError, OSError), e:
+        print "Could not save kinfo cache: " + str(e)
+
+
 # parse the Kindleinfo file to calculate the book pid.
 
 keynames = ["kindle.account.tokens","kindle.cookie.item","eulaVersionAccepted","login_date","kindle.token.item","login","kindle.key.item","kindle.name.info","kindle.device.info", "MazamaRandomNumber"]
 
-def getK4Pids(pidlst, rec209, token, kInfoFile):
+# Returns the DSN and account token for a Kindleinfo file, or None.
+# These only depend on the file, not on the book.
+def getK4DeviceValues(kInfoFile):
     global charMap1
+    global pidCacheHits
+    global pidCacheMisses
+    cacheKey = None
+    if usePidCache:
+        try:
+            cacheKey = binascii.hexlify(SHA1(file(kInfoFile, 'rb').read()))
+        except IOError:
+            pass
+        if cacheKey in loadPidCache():
+            pidCacheHits += 1
+            return pidCache[cacheKey]
+        pidCacheMisses += 1
+
     kindleDatabase = None
     try:
         kindleDatabase = getDBfromFile(kInfoFile)
@@ -206,7 +274,7 @@ def getK4Pids(pidlst, rec209, token, kInfoFile):
         pass
 
     if kindleDatabase == None :
-        return pidlst
+        return None
 
     try:
         # Get the Mazama Random number
@@ -216,7 +284,7 @@ def getK4Pids(pidlst, rec209, token, kInfoFile):
         kindleAccountToken = kindleDatabase["kindle.account.tokens"]
     except KeyError:
         print "Keys not found in " + kInfoFile
-        return pidlst
+        return None
 
     # Get the ID string used
     encodedIDString = encodeHash(GetIDString(),charMap1)
@@ -227,6 +295,17 @@ def getK4Pids(pidlst, rec209, token, kInfoFile):
     # concat, hash and encode to calculate the DSN
     DSN = encode(SHA1(MazamaRandomNumber+encodedIDString+encodedUsername),charMap1)
 
+    if cacheKey is not None:
+        pidCache[cacheKey] = (DSN, kindleAccountToken)
+        savePidCache()
+    return DSN, kindleAccountToken
+
+def getK4Pids(pidlst, rec209, token, kInfoFile):
+    values = getK4DeviceValues(kInfoFile)
+    if values == None :
+        return pidlst
+    DSN, kindleAccountToken = values
+
     # Compute the device PID (for which I can tell, is used for nothing).
     table =  generatePidEncryptionTable()
     devicePID = generateDevicePID(table,DSN,4)
@@ -266,6 +345,8 @@ def getPidList(md1, md2, k4 = True, serials=[], kInfoFiles=[]):
             pidlst = getK4Pids(pidlst, md1, md2, infoFile)
         except Exception, message:
             print("Error getting PIDs from " + infoFile + ": " + message)
+    if usePidCache and kInfoFiles:
+        print "kinfo cache: %d hit(s), %d miss(es)" % (pidCacheHits, pidCacheMisses)
     for serialnum in serials:
         try:
             pidlst = getKindlePid(pidlst, md1, md2, serialnum)
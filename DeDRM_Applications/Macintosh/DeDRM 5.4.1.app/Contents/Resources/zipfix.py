@@ -13,6 +13,7 @@ _FILENAME_LEN_OFFSET = 26
 _EXTRA_LEN_OFFSET = 28
 _FILENAME_OFFSET = 30
 _MAX_SIZE = 64 * 1024
+_LOCAL_MAGIC = 'PK\003\004'
 _MIMETYPE = 'application/epub+zip'
 
 class ZipInfo(zipfilerugged.ZipInfo):
@@ -36,66 +37,115 @@ class fixZip:
         self.bzf = file(zinput,'rb')
         print "finished initialising"
 
-    def getlocalname(self, zi):
+    # read the local header of member zi, returns whether its magic number
+    # is right, the name it holds and the offset of the member data
+    def getlocalheader(self, zi):
         local_header_offset = zi.header_offset
-        self.bzf.seek(local_header_offset + _FILENAME_LEN_OFFSET)
-        leninfo = self.bzf.read(2)
-        local_name_length, = unpack('<H', leninfo)
-        self.bzf.seek(local_header_offset + _FILENAME_OFFSET)
+        self.bzf.seek(local_header_offset)
+        header = self.bzf.read(_FILENAME_OFFSET)
+        if len(header) < _FILENAME_OFFSET:
+            return False, '', local_header_offset
+        local_name_length, extra_field_length = unpack('<HH', header[_FILENAME_LEN_OFFSET:_FILENAME_OFFSET])
         local_name = self.bzf.read(local_name_length)
-        return local_name
-
-    def uncompress(self, cmpdata):
+        data_offset = local_header_offset + _FILENAME_OFFSET + local_name_length + extra_field_length
+        return header[0:4] == _LOCAL_MAGIC, local_name, data_offset
+
+    # the stored (possibly compressed) bytes of a member, _MAX_SIZE at a time
+    def getrawdata(self, data_offset, size):
+        self.bzf.seek(data_offset)
+        while size > 0:
+            data = self.bzf.read(min(size, _MAX_SIZE))
+            if len(data) == 0:
+                break
+            size -= len(data)
+            yield data
+
+    # inflate a raw deflate stream given in pieces, yields at most
+    # _MAX_SIZE bytes at a time
+    def uncompresschunks(self, chunks):
         dc = zlib.decompressobj(-15)
-        data = ''
-        while len(cmpdata) > 0:
-            if len(cmpdata) > _MAX_SIZE :
-                newdata = cmpdata[0:_MAX_SIZE]
-                cmpdata = cmpdata[_MAX_SIZE:]
-            else:
-                newdata = cmpdata
-                cmpdata = ''
-            newdata = dc.decompress(newdata)
-            unprocessed = dc.unconsumed_tail
-            if len(unprocessed) == 0:
-                newdata += dc.flush()
-            data += newdata
-            cmpdata += unprocessed
-            unprocessed = ''
-        return data
-
-    def getfiledata(self, zi):
-        # get file name length and exta data length to find start of file data
-        local_header_offset = zi.header_offset
-
-        self.bzf.seek(local_header_offset + _FILENAME_LEN_OFFSET)
-        leninfo = self.bzf.read(2)
-        local_name_length, = unpack('<H', leninfo)
-
-        self.bzf.seek(local_header_offset + _EXTRA_LEN_OFFSET)
-        exinfo = self.bzf.read(2)
-        extra_field_length, = unpack('<H', exinfo)
-
-        self.bzf.seek(local_header_offset + _FILENAME_OFFSET + local_name_length + extra_field_length)
-        data = None
-
+        for cmpdata in chunks:
+            while len(cmpdata) > 0:
+                data = dc.decompress(cmpdata, _MAX_SIZE)
+                cmpdata = dc.unconsumed_tail
+                if len(data) > 0:
+                    yield data
+                elif len(cmpdata) > 0:
+                    break
+        data = dc.flush()
+        if len(data) > 0:
+            yield data
+
+    # the uncompressed contents of member zi, in pieces
+    def getfilechunks(self, zi, data_offset):
         # if not compressed we are good to go
         if zi.compress_type == zipfilerugged.ZIP_STORED:
-            data = self.bzf.read(zi.file_size)
+            return self.getrawdata(data_offset, zi.file_size)
 
         # if compressed we must decompress it using zlib
         if zi.compress_type == zipfilerugged.ZIP_DEFLATED:
-            cmpdata = self.bzf.read(zi.compress_size)
-            data = self.uncompress(cmpdata)
-
-        return data
-
-
+            return self.uncompresschunks(self.getrawdata(data_offset, zi.compress_size))
+
+        return None
+
+    # start writing member nzinfo to the output archive
+    def beginmember(self, nzinfo):
+        nzinfo.header_offset = self.outzip.fp.tell()
+        self.outzip._writecheck(nzinfo)
+        self.outzip._didModify = True
+        self.outzip.fp.write(nzinfo.FileHeader())
+
+    def endmember(self, nzinfo):
+        self.outzip.filelist.append(nzinfo)
+        self.outzip.NameToInfo[nzinfo.filename] = nzinfo
+
+    # copy the stored bytes of a healthy member as they are, its CRC and
+    # sizes in the central directory still hold
+    def copymember(self, nzinfo, data_offset):
+        size = nzinfo.compress_size
+        self.beginmember(nzinfo)
+        for data in self.getrawdata(data_offset, size):
+            self.outzip.fp.write(data)
+            size -= len(data)
+        if size > 0:
+            raise zipfilerugged.BadZipfile("Truncated data for member %s" % nzinfo.filename)
+        self.endmember(nzinfo)
+
+    # write a member from its uncompressed contents given in pieces,
+    # the header is rewritten once the CRC and sizes are known
+    def writemember(self, nzinfo, chunks):
+        nzinfo.CRC = crc = 0
+        nzinfo.file_size = file_size = 0
+        nzinfo.compress_size = compress_size = 0
+        self.beginmember(nzinfo)
+        co = None
+        if nzinfo.compress_type == zipfilerugged.ZIP_DEFLATED:
+            co = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        for data in chunks:
+            file_size += len(data)
+            crc = zlib.crc32(data, crc)
+            if co:
+                data = co.compress(data)
+            compress_size += len(data)
+            self.outzip.fp.write(data)
+        if co:
+            data = co.flush()
+            compress_size += len(data)
+            self.outzip.fp.write(data)
+        nzinfo.CRC = crc & 0xffffffff
+        nzinfo.file_size = file_size
+        nzinfo.compress_size = compress_size
+        position = self.outzip.fp.tell()
+        self.outzip.fp.seek(nzinfo.header_offset, 0)
+        self.outzip.fp.write(nzinfo.FileHeader())
+        self.outzip.fp.seek(position, 0)
+        self.endmember(nzinfo)
 
     def fix(self):
         # get the zipinfo for each member of the input archive
         # and copy member over to output archive
-        # if problems exist with local vs central filename, fix them
+        # healthy members are copied without being decompressed, only
+        # those whose local and central filenames differ are rewritten
 
         # if epub write mimetype file first, with no compression
         if self.ztype == 'epub':
@@ -105,20 +155,20 @@ class fixZip:
         # write the rest of the files
         for zinfo in self.inzip.infolist():
             if zinfo.filename != "mimetype" or self.ztype == '.zip':
-                data = None
+                is_local, local_name, data_offset = self.getlocalheader(zinfo)
                 nzinfo = zinfo
-                try:
-                    data = self.inzip.read(zinfo.filename)
-                except zipfilerugged.BadZipfile or zipfilerugged.error:
-                    local_name = self.getlocalname(zinfo)
-                    data = self.getfiledata(zinfo)
-                    nzinfo.filename = local_name
-
                 nzinfo.date_time = zinfo.date_time
                 nzinfo.compress_type = zinfo.compress_type
                 nzinfo.flag_bits = 0
                 nzinfo.internal_attr = 0
-                self.outzip.writestr(nzinfo,data)
+                chunks = None
+                if not is_local or local_name != zinfo.orig_filename:
+                    chunks = self.getfilechunks(zinfo, data_offset)
+                    nzinfo.filename = local_name
+                if chunks is None:
+                    self.copymember(nzinfo, data_offset)
+                else:
+                    self.writemember(nzinfo, chunks)
 
         self.bzf.close()
         self.inzip.close()
@@ -19,6 +19,7 @@ import os
 import getopt
 from struct import pack
 from struct import unpack
+from bisect import bisect_left
 
 class TpzDRMError(Exception):
     pass
@@ -55,6 +56,32 @@ def readEncodedNumber(file):
     return data
 
 
+# Same as readEncodedNumber but decodes from a bytearray at pos and
+# returns the number with the position after it. The number is None
+# if the data runs out.
+
+def decodeNumber(data, pos):
+    try:
+        c = data[pos]
+        pos += 1
+        flag = (c == 0xFF)
+        if flag:
+            c = data[pos]
+            pos += 1
+        if c >= 0x80:
+            datax = (c & 0x7F)
+            while c >= 0x80 :
+                c = data[pos]
+                pos += 1
+                datax = (datax <<7) + (c & 0x7F)
+            c = datax
+    except IndexError:
+        return None, len(data)
+    if flag:
+        c = -c
+    return c, pos
+
+
 # returns a binary string that encodes a number into 7 bits
 # most significant byte first which has the high bit set
 
@@ -99,6 +126,15 @@ def readString(file):
         return ""
     return unpack(str(stringLength)+"s",sv)[0]
 
+def decodeString(data, pos):
+    stringLength, pos = decodeNumber(data, pos)
+    if (stringLength == None):
+        return "", pos
+    end = pos + stringLength
+    if (end > len(data)):
+        return "", len(data)
+    return str(data[pos:end]), end
+
 
 # convert a binary string generated by encodeNumber (7 bit encoded number)
 # to the value you would find inside the page*.dat files to be processed
@@ -115,16 +151,33 @@ def convert(i):
 
 # the complete string table used to store all book text content
 # as well as the xml tokens and values that make sense out of it
+# (read from dictFile, or from data if the record is already in memory)
+# strings are kept as stored and only escaped the first time they are
+# looked up, most entries of a large table are never used by a page
 
 class Dictionary(object):
-    def __init__(self, dictFile):
+    def __init__(self, dictFile, data=None):
         self.filename = dictFile
         self.size = 0
-        self.fo = file(dictFile,'rb')
-        self.stable = []
-        self.size = readEncodedNumber(self.fo)
+        if data is None:
+            data = file(dictFile,'rb').read()
+        data = bytearray(data)
+        dlen = len(data)
+        self.stable = stable = []
+        self.size, pos = decodeNumber(data, 0)
+        if self.size is None:
+            self.size = 0
         for i in xrange(self.size):
-            self.stable.append(self.escapestr(readString(self.fo)))
+            # nearly all strings are shorter than 128 bytes and have
+            # a one byte length
+            if pos < dlen and data[pos] < 0x80 and pos + 1 + data[pos] <= dlen:
+                end = pos + 1 + data[pos]
+                stable.append(str(data[pos+1:end]))
+                pos = end
+            else:
+                sv, pos = decodeString(data, pos)
+                stable.append(sv)
+        self.escaped = [None] * self.size
         self.pos = 0
 
     def escapestr(self, str):
@@ -137,7 +190,10 @@ class Dictionary(object):
     def lookup(self,val):
         if ((val >= 0) and (val < self.size)) :
             self.pos = val
-            return self.stable[self.pos]
+            sv = self.escaped[val]
+            if sv is None:
+                sv = self.escaped[val] = self.escapestr(self.stable[val])
+            return sv
         else:
             print "Error - %d outside of string table limits" % val
             raise TpzDRMError('outside of string table limits')
@@ -151,16 +207,21 @@ class Dictionary(object):
 
     def dumpDict(self):
         for i in xrange(self.size):
-            print "%d %s %s" % (i, convert(i), self.stable[i])
+            print "%d %s %s" % (i, convert(i), self.lookup(i))
         return
 
 # parses the xml snippets that are represented by each page*.dat file.
 # also parses the other0.dat file - the main stylesheet
 # and information used to inject the xml snippets into page*.dat files
+# the file contents can be passed in data, filename then only names the page
 
 class PageParser(object):
-    def __init__(self, filename, dict, debug, flat_xml):
-        self.fo = file(filename,'rb')
+    def __init__(self, filename, dict, debug, flat_xml, data=None):
+        if data is None:
+            data = file(filename,'rb').read()
+        # the whole page is decoded from memory, pos is the read position
+        self.data = bytearray(data)
+        self.pos = 0
         self.id = os.path.basename(filename).replace('.dat','')
         self.dict = dict
         self.debug = debug
@@ -394,21 +455,21 @@ class PageParser(object):
 
     # peek at and return 1 byte that is ahead by i bytes
     def peek(self, aheadi):
-        c = self.fo.read(aheadi)
-        if (len(c) == 0):
+        pos = self.pos + aheadi - 1
+        if (pos >= len(self.data)):
             return None
-        self.fo.seek(-aheadi,1)
-        c = c[-1:]
-        return ord(c)
+        return self.data[pos]
+
+
+    # read the next 7 bit encoded number, None at the end of the data
+    def readNumber(self):
+        val, self.pos = decodeNumber(self.data, self.pos)
+        return val
 
 
     # get the next value from the file being processed
     def getNext(self):
-        nbyte = self.peek(1);
-        if (nbyte == None):
-            return None
-        val = readEncodedNumber(self.fo)
-        return val
+        return self.readNumber()
 
 
     # format an arg by argtype
@@ -452,15 +513,15 @@ class PageParser(object):
             if (splcase == 1):
                 # this type of tag uses of escape marker 0x74 indicate subtag count
                 if self.peek(1) == 0x74:
-                    skip = readEncodedNumber(self.fo)
+                    skip = self.readNumber()
                     subtags = 1
                     num_args = 0
 
             if (subtags == 1):
-                ntags = readEncodedNumber(self.fo)
+                ntags = self.readNumber()
                 if self.debug : print 'subtags: ' + token + ' has ' + str(ntags)
                 for j in xrange(ntags):
-                    val = readEncodedNumber(self.fo)
+                    val = self.readNumber()
                     subtagres.append(self.procToken(self.dict.lookup(val)))
 
             # arguments can be scalars or vectors of text or numbers
@@ -469,12 +530,12 @@ class PageParser(object):
                 firstarg = self.peek(1)
                 if (firstarg in self.cmd_list) and (argtype != 'scalar_number') and (argtype != 'scalar_text'):
                     # single argument is a variable length vector of data
-                    arg = readEncodedNumber(self.fo)
+                    arg = self.readNumber()
                     argres = self.decodeCMD(arg,argtype)
                 else :
                     # num_arg scalar arguments
                     for i in xrange(num_args):
-                        argres.append(self.formatArg(readEncodedNumber(self.fo), argtype))
+                        argres.append(self.formatArg(self.readNumber(), argtype))
 
             # build the return tag
             result = []
@@ -501,7 +562,7 @@ class PageParser(object):
     # it is NEVER used to format arguments.
     # builds the snippetList
     def doLoop72(self, argtype):
-        cnt = readEncodedNumber(self.fo)
+        cnt = self.readNumber()
         if self.debug :
             result = 'Set of '+ str(cnt) + ' xml snippets. The overall structure \n'
             result += 'of the document is indicated by snippet number sets at the\n'
@@ -511,7 +572,7 @@ class PageParser(object):
             if self.debug: print 'Snippet:',str(i)
             snippet = []
             snippet.append(i)
-            val = readEncodedNumber(self.fo)
+            val = self.readNumber()
             snippet.append(self.procToken(self.dict.lookup(val)))
             self.snippetList.append(snippet)
         return
@@ -523,14 +584,28 @@ class PageParser(object):
         result = []
         adj = 0
         if mode & 1:
-            adj = readEncodedNumber(self.fo)
+            adj = self.readNumber()
         mode = mode >> 1
         x = []
+        data = self.data
+        size = len(data)
+        pos = self.pos
         for i in xrange(cnt):
-            x.append(readEncodedNumber(self.fo) - adj)
+            # single byte values need no decoding
+            if pos < size and data[pos] < 0x80:
+                x.append(data[pos] - adj)
+                pos += 1
+            else:
+                val, pos = decodeNumber(data, pos)
+                x.append(val - adj)
+        self.pos = pos
         for i in xrange(mode):
-            for j in xrange(1, cnt):
-                x[j] = x[j] + x[j - 1]
+            total = 0
+            for j in xrange(cnt):
+                total += x[j]
+                x[j] = total
+        if argtype in ('raw', 'number', 'scalar_number', 'snippets'):
+            return x
         for i in xrange(cnt):
             result.append(self.formatArg(x[i],argtype))
         return result
@@ -547,8 +622,8 @@ class PageParser(object):
         if (cmd == 0x76):
 
             # loop with cnt, and mode to control loop styles
-            cnt = readEncodedNumber(self.fo)
-            mode = readEncodedNumber(self.fo)
+            cnt = self.readNumber()
+            mode = self.readNumber()
 
             if self.debug : print 'Loop for', cnt, 'with  mode', mode,  ':  '
             return self.doLoop76Mode(argtype, cnt, mode)
@@ -698,21 +773,22 @@ class PageParser(object):
     def process(self):
 
         # peek at the first bytes to see what type of file it is
-        magic = self.fo.read(9)
+        magic = str(self.data[0:9])
+        self.pos = 9
         if (magic[0:1] == 'p') and (magic[2:9] == 'marker_'):
             first_token = 'info'
         elif (magic[0:1] == 'p') and (magic[2:9] == '__PAGE_'):
-            skip = self.fo.read(2)
+            self.pos += 2
             first_token = 'info'
         elif (magic[0:1] == 'p') and (magic[2:8] == '_PAGE_'):
             first_token = 'info'
         elif (magic[0:1] == 'g') and (magic[2:9] == '__GLYPH'):
-            skip = self.fo.read(3)
+            self.pos += 3
             first_token = 'info'
         else :
             # other0.dat file
             first_token = None
-            self.fo.seek(-9,1)
+            self.pos = 0
 
 
         # main loop to read and build the document tree
@@ -740,7 +816,7 @@ class PageParser(object):
                     print "Main Loop:  Unknown value: %x" % v
                 if (v == 0):
                     if (self.peek(1) == 0x5f):
-                        skip = self.fo.read(1)
+                        self.pos += 1
                         first_token = 'info'
 
         # now do snippet injection
@@ -759,20 +835,165 @@ class PageParser(object):
         return xmlpage
 
 
-def fromData(dict, fname):
+# the flattened xml of a page split into lines once, with the tag path
+# and argument string of each line. The lines holding a tag path are
+# looked up through an index, so the renderers do not have to scan the
+# whole document for each query.
+
+class FlatDoc(object):
+    def __init__(self, flatxml):
+        self.names = []
+        self.args = []
+        for item in flatxml.split('\n'):
+            if item.find('=') >= 0:
+                (name, argres) = item.split('=',1)
+            else :
+                name = item
+                argres = ''
+            self.names.append(name)
+            self.args.append(argres)
+        self.size = len(self.names)
+        # line numbers of each distinct tag path
+        self.byname = {}
+        for j in xrange(self.size):
+            self.byname.setdefault(self.names[j], []).append(j)
+        # line numbers of the tag paths ending with a queried suffix
+        self.suffixes = {}
+        # arguments already converted to integers, by line
+        self.numbers = {}
+
+    # sorted line numbers of all tags whose path ends with tagpath
+    def positions(self, tagpath):
+        result = self.suffixes.get(tagpath)
+        if result == None:
+            result = []
+            for name, lines in self.byname.iteritems():
+                if name.endswith(tagpath):
+                    result.extend(lines)
+            result.sort()
+            self.suffixes[tagpath] = result
+        return result
+
+    # first line in pos to end (exclusive, -1 for the end of the document)
+    # whose tag path ends with tagpath, and its arguments
+    def find(self, tagpath, pos, end):
+        if (end == -1) or (end > self.size):
+            end = self.size
+        lines = self.positions(tagpath)
+        i = bisect_left(lines, pos)
+        if (i < len(lines)) and (lines[i] < end):
+            foundat = lines[i]
+            return foundat, self.args[foundat]
+        return -1, None
+
+    # first line whose tag path is exactly name, -1 if there is none
+    def findExact(self, name):
+        lines = self.byname.get(name)
+        if lines:
+            return lines[0]
+        return -1
+
+    def line(self, pos):
+        return self.names[pos], self.args[pos]
+
+    # the arguments of a line as a list of integers, the list is cached
+    # so callers that change it must copy it first
+    def getNumbers(self, pos):
+        result = self.numbers.get(pos)
+        if result == None:
+            argt = self.args[pos]
+            if len(argt) > 0:
+                result = [int(strval) for strval in argt.split('|')]
+            else:
+                result = []
+            self.numbers[pos] = result
+        return result
+
+# accept either flat xml text or a FlatDoc already made from it
+def getFlatDoc(flatxml):
+    if isinstance(flatxml, FlatDoc):
+        return flatxml
+    return FlatDoc(flatxml)
+
+def fromData(dict, fname, data=None):
     flat_xml = True
     debug = False
-    pp = PageParser(fname, dict, debug, flat_xml)
+    pp = PageParser(fname, dict, debug, flat_xml, data)
     xmlpage = pp.process()
     return xmlpage
 
-def getXML(dict, fname):
+def getXML(dict, fname, data=None):
     flat_xml = False
     debug = False
-    pp = PageParser(fname, dict, debug, flat_xml)
+    pp = PageParser(fname, dict, debug, flat_xml, data)
     xmlpage = pp.process()
     return xmlpage
 
+# build a synthetic dictionary and page*.dat record of nwords words,
+# with four glyphs per word and a paragraph for every 50 words
+
+def makeTestPage(nwords):
+    tags = ['info', 'word', 'ocrText', 'firstGlyph', 'lastGlyph', 'glyph', 'x', 'y', 'glyphID',
+            'page', 'type', 'h', 'w', 'region', 'paragraph', 'class', 'firstWord', 'lastWord',
+            'text', 'body']
+    words = ['word%d' % i for i in xrange(200)]
+    stable = [''] + tags + words
+    index = {}
+    for i in xrange(len(stable)):
+        index[stable[i]] = i
+    dictdata = encodeNumber(len(stable)) + "".join([lengthPrefixString(sv) for sv in stable])
+
+    def tag(name, ntags):
+        return encodeNumber(index[name]) + encodeNumber(ntags)
+    def vector(values, mode):
+        return encodeNumber(0x76) + encodeNumber(len(values)) + encodeNumber(mode) + "".join([encodeNumber(v) for v in values])
+
+    nglyphs = 4 * nwords
+    plst = []
+    plst.append('p\x01__PAGE_\x00\x00')
+    # the info tag is implied by the page magic
+    plst.append(encodeNumber(2))
+    plst.append(tag('word', 3))
+    plst.append(encodeNumber(index['ocrText']) + vector([index[words[i % 200]] for i in xrange(nwords)], 0))
+    plst.append(encodeNumber(index['firstGlyph']) + vector([4 * i for i in xrange(nwords)], 0))
+    plst.append(encodeNumber(index['lastGlyph']) + vector([4 * i + 4 for i in xrange(nwords)], 0))
+    plst.append(tag('glyph', 3))
+    plst.append(encodeNumber(index['x']) + vector([(i * 7919) % 8000 for i in xrange(nglyphs)], 0))
+    plst.append(encodeNumber(index['y']) + vector([(i * 104729) % 11000 for i in xrange(nglyphs)], 0))
+    plst.append(encodeNumber(index['glyphID']) + vector([i % 700 for i in xrange(nglyphs)], 2))
+    nparas = (nwords + 49) / 50
+    plst.append(tag('page', 3 + nparas))
+    plst.append(encodeNumber(index['type']) + encodeNumber(index['text']))
+    plst.append(encodeNumber(index['h']) + encodeNumber(11000))
+    plst.append(encodeNumber(index['w']) + encodeNumber(8500))
+    for i in xrange(nparas):
+        plst.append(tag('region', 2))
+        plst.append(encodeNumber(index['type']) + encodeNumber(index['text']))
+        plst.append(tag('paragraph', 3))
+        plst.append(encodeNumber(index['class']) + encodeNumber(index['body']))
+        plst.append(encodeNumber(index['firstWord']) + encodeNumber(50 * i))
+        plst.append(encodeNumber(index['lastWord']) + encodeNumber(min(50 * i + 50, nwords)))
+        plst.append(vector([], 0))
+        plst.append(vector([], 0))
+    plst.append(vector([], 0))
+    return dictdata, "".join(plst)
+
+# time the conversion of a synthetic page
+
+def benchmark(nwords=2000, count=20):
+    import time
+    dictdata, pagedata = makeTestPage(nwords)
+    dict = Dictionary('dict0000.dat', dictdata)
+    for flat_xml in (True, False):
+        start = time.time()
+        for i in xrange(count):
+            pp = PageParser('page0000.dat', dict, False, flat_xml, pagedata)
+            xmlpage = pp.process()
+        elapsed = max(time.time() - start, 1e-6)
+        print '%s: %.1f ms per %d byte page, %.0f KB/s' % (('xml', 'flat xml')[flat_xml],
+            elapsed * 1000 / count, len(pagedata), len(pagedata) * count / 1024.0 / elapsed)
+    return 0
+
 def usage():
     print 'Usage: '
     print '    convert2xml.py dict0000.dat infile.dat '
@@ -781,6 +1002,7 @@ def usage():
     print '   -h            print this usage help message '
     print '   -d            turn on debug output to check for potential errors '
     print '   --flat-xml    output the flattened xml page description only '
+    print '   --benchmark   time the conversion of a synthetic page '
     print ' '
     print '     This program will attempt to convert a page*.dat file or '
     print ' glyphs*.dat file, using the dict0000.dat file, to its xml description. '
@@ -803,7 +1025,7 @@ def main(argv):
         argv = sys.argv
 
     try:
-        opts, args = getopt.getopt(argv[1:], "hd", ["flat-xml"])
+        opts, args = getopt.getopt(argv[1:], "hd", ["flat-xml", "benchmark"])
 
     except getopt.GetoptError, err:
 
@@ -824,6 +1046,8 @@ def main(argv):
             sys.exit(0)
         if o =="--flat-xml":
             flat_xml = True
+        if o =="--benchmark":
+            return benchmark()
 
     dictFile, pageFile = args[0], args[1]
 
@@ -18,6 +18,65 @@ import ineptepub
 import ignobleepub
 import zipfix
 import re
+import struct
+import hashlib
+import zipfilerugged
+import xml.etree.ElementTree as etree
+from contextlib import closing
+
+# file in the resource directory that notes which key file fits the
+# books with a given key id, so later books go straight to that key
+KEY_INDEX = 'epubkeys.txt'
+
+# The key id of a book: a SHA-1 of the user its license was issued to,
+# or of the encrypted book key if rights.xml names no user. None if
+# the book has no readable rights.xml.
+def getKeyId(zippath):
+    try:
+        with closing(ineptepub.openBook(zippath)) as inf:
+            rights = etree.fromstring(inf.read('META-INF/rights.xml'))
+    except Exception:
+        return None
+    adept = lambda tag: '{%s}%s' % (ineptepub.NSMAP['adept'], tag)
+    keyid = rights.findtext('.//%s' % (adept('user'),)) or \
+            rights.findtext('.//%s' % (adept('encryptedKey'),))
+    if not keyid:
+        return None
+    return hashlib.sha1(keyid.strip()).hexdigest()
+
+# check that the decryptors can read the epub in zippath without fixing
+def readableBook(zippath):
+    try:
+        inf = ineptepub.openBook(zippath)
+        inf.close()
+    except (zipfilerugged.BadZipfile, zipfilerugged.LargeZipFile, IOError, struct.error):
+        return False
+    return True
+
+def loadKeyIndex(rscpath):
+    index = {}
+    try:
+        for line in file(os.path.join(rscpath, KEY_INDEX), 'rb'):
+            fields = line.rstrip('\r\n').split(':', 1)
+            if len(fields) == 2:
+                index[fields[0]] = fields[1]
+    except IOError:
+        pass
+    return index
+
+def saveKeyIndex(rscpath, index):
+    path = os.path.join(rscpath, KEY_INDEX)
+    tmppath = path + '.%d' % os.getpid()
+    try:
+        f = file(tmppath, 'wb')
+        for keyid, filename in index.items():
+            f.write('%s:%s\n' % (keyid, filename))
+        f.close()
+        if sys.platform.startswith('win') and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmppath, path)
+    except (IOError, OSError), e:
+        print "Could not save key index: " + str(e)
 
 def main(argv=sys.argv):
     args = argv[1:]
@@ -28,57 +87,54 @@ def main(argv=sys.argv):
     rscpath = args[2]
     errlog = ''
 
-    # first fix the epub to make sure we do not get errors
-    name, ext = os.path.splitext(os.path.basename(infile))
-    bpath = os.path.dirname(infile)
-    zippath = os.path.join(bpath,name + '_temp.zip')
-    rv = zipfix.repairBook(infile, zippath)
-    if rv != 0:
-        print "Error while trying to fix epub"
-        return rv
-
     # determine a good name for the output file
+    name, ext = os.path.splitext(os.path.basename(infile))
     outfile = os.path.join(outdir, name + '_nodrm.epub')
 
-    rv = 1
-    # first try with the Adobe adept epub
-    # try with any keyfiles (*.der) in the rscpath
-    files = os.listdir(rscpath)
-    filefilter = re.compile("\.der$", re.IGNORECASE)
-    files = filter(filefilter.search, files)
-    if files:
-        for filename in files:
-            keypath = os.path.join(rscpath, filename)
-            try:
-                rv = ineptepub.decryptBook(keypath, zippath, outfile)
-                if rv == 0:
-                    break
-            except Exception, e:
-                errlog += str(e)
-                rv = 1
-                pass
-    if rv == 0:
-        os.remove(zippath)
-        return 0
+    # the decryptors read the epub as it is and cope with members whose
+    # local and central names differ. Only an epub they cannot read is
+    # first fixed, into a temporary copy next to the output file.
+    zippath = infile
+    if not readableBook(infile):
+        zippath = os.path.join(outdir, name + '_temp.zip')
+        rv = zipfix.repairBook(infile, zippath)
+        if rv != 0:
+            print "Error while trying to fix epub"
+            return rv
 
-    # still no luck
-    # now try with ignoble epub
-    # try with any keyfiles (*.b64) in the rscpath
+    # the Adobe adept keyfiles (*.der) in the rscpath, then the ignoble
+    # epub keyfiles (*.b64). The key that fit the last book with the
+    # same key id is tried first.
     files = os.listdir(rscpath)
-    filefilter = re.compile("\.b64$", re.IGNORECASE)
-    files = filter(filefilter.search, files)
-    if files:
-        for filename in files:
-            keypath = os.path.join(rscpath, filename)
-            try:
-                rv = ignobleepub.decryptBook(keypath, zippath, outfile)
-                if rv == 0:
-                    break
-            except Exception, e:
-                errlog += str(e)
-                rv = 1
-                pass
-    os.remove(zippath)
+    keyfiles = []
+    for pattern, module in (("\.der$", ineptepub), ("\.b64$", ignobleepub)):
+        filefilter = re.compile(pattern, re.IGNORECASE)
+        keyfiles += [(filename, module) for filename in filter(filefilter.search, files)]
+    keyid = getKeyId(zippath)
+    index = loadKeyIndex(rscpath)
+    if keyid in index:
+        keyfiles.sort(key=lambda keyfile: keyfile[0] != index[keyid])
+
+    rv = 1
+    for filename, module in keyfiles:
+        keypath = os.path.join(rscpath, filename)
+        try:
+            # only META-INF/rights.xml is needed to rule out a key
+            if not module.probeKey(keypath, zippath):
+                errlog += "%s does not fit this book\n" % filename
+                continue
+            rv = module.decryptBook(keypath, zippath, outfile)
+            if rv == 0:
+                if keyid is not None and index.get(keyid) != filename:
+                    index[keyid] = filename
+                    saveKeyIndex(rscpath, index)
+                break
+        except Exception, e:
+            errlog += str(e)
+            rv = 1
+            pass
+    if zippath != infile:
+        os.remove(zippath)
     if rv != 0:
         print errlog
     return rv
@@ -62,8 +62,9 @@
 #  0.21 - Support eReader (drm) version 11.
 #       - Don't reject dictionary format.
 #       - Ignore sidebars for dictionaries (different format?)
+#  0.22 - Use the shared palmdb reader instead of reading the whole file
 
-__version__='0.21'
+__version__='0.22'
 
 class Unbuffered:
     def __init__(self, stream):
@@ -82,6 +83,11 @@ if 'calibre' in sys.modules:
 else:
     inCalibre = False
 
+if inCalibre:
+    from calibre_plugins.erdrpdb2pml.palmdb import PalmDB
+else:
+    from palmdb import PalmDB
+
 Des = None
 if sys.platform.startswith('win'):
     # first try with pycrypto
@@ -142,31 +148,18 @@ logging.basicConfig()
 #logging.basicConfig(level=logging.DEBUG)
 
 
-class Sectionizer(object):
+class Sectionizer(PalmDB):
     bkType = "Book"
 
     def __init__(self, filename, ident):
-        self.contents = file(filename, 'rb').read()
-        self.header = self.contents[0:72]
-        self.num_sections, = struct.unpack('>H', self.contents[76:78])
+        PalmDB.__init__(self, filename)
         # Dictionary or normal content (TODO: Not hard-coded)
-        if self.header[0x3C:0x3C+8] != ident:
-            if self.header[0x3C:0x3C+8] == "PDctPPrs":
+        if self.ident != ident:
+            if self.ident == "PDctPPrs":
                 self.bkType = "Dict"
             else:
+                self.close()
                 raise ValueError('Invalid file format')
-        self.sections = []
-        for i in xrange(self.num_sections):
-            offset, a1,a2,a3,a4 = struct.unpack('>LBBBB', self.contents[78+i*8:78+i*8+8])
-            flags, val = a1, a2<<16|a3<<8|a4
-            self.sections.append( (offset, flags, val) )
-    def loadSection(self, section):
-        if section + 1 == self.num_sections:
-            end_off = len(self.contents)
-        else:
-            end_off = self.sections[section + 1][0]
-        off = self.sections[section][0]
-        return self.contents[off:end_off]
 
 def sanitizeFileName(s):
     r = ''
@@ -10,13 +10,24 @@ import getopt
 from struct import pack
 from struct import unpack
 
+if 'calibre' in sys.modules:
+    inCalibre = True
+else:
+    inCalibre = False
 
+if inCalibre :
+    from calibre_plugins.k4mobidedrm import convert2xml
+else :
+    import convert2xml
+
+
+# flatxml is the flat xml text of the page or a convert2xml.FlatDoc
 class DocParser(object):
     def __init__(self, flatxml, classlst, fileid, bookDir, gdict, fixedimage):
         self.id = os.path.basename(fileid).replace('.dat','')
         self.svgcount = 0
-        self.docList = flatxml.split('\n')
-        self.docSize = len(self.docList)
+        self.doc = convert2xml.getFlatDoc(flatxml)
+        self.docSize = self.doc.size
         self.classList = {}
         self.bookDir = bookDir
         self.gdict = gdict
@@ -39,17 +50,10 @@ class DocParser(object):
 
 
     def getGlyph(self, gid):
-        result = ''
-        id='id="gl%d"' % gid
-        return self.gdict.lookup(id)
+        return self.gdict.lookup(gid)
 
     def glyphs_to_image(self, glyphList):
 
-        def extract(path, key):
-            b = path.find(key) + len(key)
-            e = path.find(' ',b)
-            return int(path[b:e])
-
         svgDir = os.path.join(self.bookDir,'svg')
 
         imgDir = os.path.join(self.bookDir,'img')
@@ -87,8 +91,9 @@ class DocParser(object):
             path = self.getGlyph(gid)
             gdefs.append(path)
 
-            maxws.append(extract(path,'width='))
-            maxhs.append(extract(path,'height='))
+            (maxw, maxh) = self.gdict.getSize(gid)
+            maxws.append(maxw)
+            maxhs.append(maxh)
 
 
         # change the origin to minx, miny and calc max height and width
@@ -121,48 +126,18 @@ class DocParser(object):
     # return tag at line pos in document
     def lineinDoc(self, pos) :
         if (pos >= 0) and (pos < self.docSize) :
-            item = self.docList[pos]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=',1)
-            else :
-                name = item
-                argres = ''
+            (name, argres) = self.doc.line(pos)
         return name, argres
 
 
     # find tag in doc if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
-        result = None
-        if end == -1 :
-            end = self.docSize
-        else:
-            end = min(self.docSize, end)
-        foundat = -1
-        for j in xrange(pos, end):
-            item = self.docList[j]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=',1)
-            else :
-                name = item
-                argres = ''
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
-        return foundat, result
+        return self.doc.find(tagpath, pos, end)
 
 
     # return list of start positions for the tagpath
     def posinDoc(self, tagpath):
-        startpos = []
-        pos = 0
-        res = ""
-        while res != None :
-            (foundpos, res) = self.findinDoc(tagpath, pos, -1)
-            if res != None :
-                startpos.append(foundpos)
-            pos = foundpos + 1
-        return startpos
+        return list(self.doc.positions(tagpath))
 
 
     # returns a vector of integers for the tagpath
@@ -170,8 +145,7 @@ class DocParser(object):
         argres=[]
         (foundat, argt) = self.findinDoc(tagpath, pos, end)
         if (argt != None) and (len(argt) > 0) :
-            argList = argt.split('|')
-            argres = [ int(strval) for strval in argList]
+            argres = self.doc.getNumbers(foundat)
         return argres
 
 
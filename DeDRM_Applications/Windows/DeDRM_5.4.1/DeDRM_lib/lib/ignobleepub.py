@@ -24,11 +24,18 @@ __license__ = 'GPL v3'
 
 import sys
 import os
+import time
+import getopt
+import collections
 import zlib
 import zipfile
 from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
 from contextlib import closing
 import xml.etree.ElementTree as etree
+try:
+    import zipfilerugged
+except ImportError:
+    zipfilerugged = None
 import Tkinter
 import Tkconstants
 import tkFileDialog
@@ -85,11 +92,12 @@ def _load_crypto_libcrypto():
             rv = AES_set_decrypt_key(userkey, len(userkey) * 8, key)
             if rv < 0:
                 raise IGNOBLEError('Failed to initialize AES key')
+            # updated by each call, so data can be decrypted in pieces
+            self._iv = create_string_buffer(16)
 
         def decrypt(self, data):
             out = create_string_buffer(len(data))
-            iv = ("\x00" * self._blocksize)
-            rv = AES_cbc_encrypt(data, out, len(data), self._key, iv, 0)
+            rv = AES_cbc_encrypt(data, out, len(data), self._key, self._iv, 0)
             if rv == 0:
                 raise IGNOBLEError('AES decryption failed')
             return out.raw
@@ -134,6 +142,11 @@ META_NAMES = ('mimetype', 'META-INF/rights.xml', 'META-INF/encryption.xml')
 NSMAP = {'adept': 'http://ns.adobe.com/adept',
          'enc': 'http://www.w3.org/2001/04/xmlenc#'}
 
+# members are read, decrypted and written in pieces of this size
+CHUNK_SIZE = 1024 * 1024
+# members waiting for or in the hands of each worker thread
+WORKER_QUEUE = 4
+
 class ZipInfo(zipfile.ZipInfo):
     def __init__(self, *args, **kwargs):
         if 'compress_type' in kwargs:
@@ -144,8 +157,9 @@ class ZipInfo(zipfile.ZipInfo):
 class Decryptor(object):
     def __init__(self, bookkey, encryption):
         enc = lambda tag: '{%s}%s' % (NSMAP['enc'], tag)
-        # self._aes = AES.new(bookkey, AES.MODE_CBC, '\x00'*16)
-        self._aes = AES(bookkey)
+        # a new AES object is made for each member, this checks the key
+        AES(bookkey)
+        self._bookkey = bookkey
         encryption = etree.fromstring(encryption)
         self._encrypted = encrypted = set()
         expr = './%s/%s/%s' % (enc('EncryptedData'), enc('CipherData'),
@@ -157,19 +171,217 @@ class Decryptor(object):
                 encrypted.add(path)
 
     def decompress(self, bytes):
-        dc = zlib.decompressobj(-15)
-        bytes = dc.decompress(bytes)
-        ex = dc.decompress('Z') + dc.flush()
-        if ex:
-            bytes = bytes + ex
-        return bytes
+        return ''.join(self.decompressChunks([bytes]))
 
     def decrypt(self, path, data):
+        return ''.join(self.decryptChunks(path, [data]))
+
+    # The contents of member path, given the chunks of its stored data.
+    # An encrypted member is decrypted and inflated as the chunks come in.
+    def decryptChunks(self, path, chunks):
         if path in self._encrypted:
-            data = self._aes.decrypt(data)[16:]
-            data = data[:-ord(data[-1])]
-            data = self.decompress(data)
-        return data
+            chunks = self.decompressChunks(self.decipherChunks(chunks))
+        return chunks
+
+    # AES-CBC decrypt the chunks of an encrypted member. The first block
+    # is the IV and the padding is removed from the last block, which is
+    # held back until the data ends.
+    def decipherChunks(self, chunks):
+        aes = AES(self._bookkey)
+        skip = 16
+        rest = ''
+        last = ''
+        for data in chunks:
+            if rest:
+                data = rest + data
+            n = len(data) & ~15
+            rest = data[n:]
+            if n == 0:
+                continue
+            if n < len(data):
+                data = data[:n]
+            data = aes.decrypt(data)
+            out = [last, data[:-16]]
+            last = data[-16:]
+            for data in out:
+                if skip:
+                    n = min(skip, len(data))
+                    data = data[n:]
+                    skip -= n
+                if data:
+                    yield data
+        if last and not skip:
+            yield last[:-ord(last[-1])]
+
+    # inflate a raw deflate stream given in chunks, at most CHUNK_SIZE
+    # bytes are produced at a time
+    def decompressChunks(self, chunks):
+        dc = zlib.decompressobj(-15)
+        for data in chunks:
+            while data:
+                bytes = dc.decompress(data, CHUNK_SIZE)
+                data = dc.unconsumed_tail
+                if bytes:
+                    yield bytes
+        ex = dc.decompress('Z') + dc.flush()
+        if ex:
+            yield ex
+
+    # Add member path of the open ZipFile inf to the open ZipFile outf
+    # as zinfo. The deflate stream of an encrypted member is written as
+    # it is, it is only inflated to find its CRC and size. A stream that
+    # does not end properly is inflated and compressed again instead.
+    def writeMember(self, inf, outf, path, zinfo):
+        if path in self._encrypted and zinfo.compress_type == ZIP_DEFLATED:
+            try:
+                with closing(inf.open(path)) as fp:
+                    writeStream(outf, zinfo, encodeChunks(zinfo, self.decipherChunks(readChunks(fp)), True))
+                return
+            except zlib.error:
+                pass
+        with closing(inf.open(path)) as fp:
+            writeStream(outf, zinfo, encodeChunks(zinfo, self.decryptChunks(path, readChunks(fp))))
+
+    # Same as writeMember, but for the whole stored data of member path
+    # and without writing anything. Returns zinfo and the list of pieces
+    # to write for it, can be called from several threads at once.
+    def encodeMember(self, path, zinfo, data):
+        if path in self._encrypted and zinfo.compress_type == ZIP_DEFLATED:
+            try:
+                return zinfo, list(encodeChunks(zinfo, self.decipherChunks([data]), True))
+            except zlib.error:
+                pass
+        return zinfo, list(encodeChunks(zinfo, self.decryptChunks(path, [data])))
+
+    # Add the members in names of the open ZipFile inf to outf, in that
+    # order. With workers > 1 the members of at most CHUNK_SIZE bytes are
+    # decrypted and compressed by a pool of threads (AES and zlib let the
+    # other threads run), while this thread reads them in and writes them
+    # out. Larger members are streamed by this thread.
+    def writeMembers(self, inf, outf, names, workers=1):
+        if workers < 2:
+            for path in names:
+                self.writeMember(inf, outf, path, memberInfo(path))
+            return
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        pending = collections.deque()
+        try:
+            for path in names:
+                if inf.getinfo(path).file_size > CHUNK_SIZE:
+                    while pending:
+                        writeStream(outf, *pending.popleft().get())
+                    self.writeMember(inf, outf, path, memberInfo(path))
+                    continue
+                args = (path, memberInfo(path), inf.read(path))
+                pending.append(pool.apply_async(self.encodeMember, args))
+                if len(pending) >= workers * WORKER_QUEUE:
+                    writeStream(outf, *pending.popleft().get())
+            while pending:
+                writeStream(outf, *pending.popleft().get())
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+# Open the book in inpath for reading. When zipfilerugged is around (it
+# comes with DeDRM) members whose local header names them differently
+# than the central directory are read under the local name, so such
+# books need no repair first.
+def openBook(inpath):
+    if zipfilerugged is None:
+        return ZipFile(open(inpath, 'rb'))
+    inf = zipfilerugged.ZipFile(open(inpath, 'rb'))
+    inf.repairNames()
+    return inf
+
+# read the open file fp in CHUNK_SIZE pieces
+def readChunks(fp):
+    while True:
+        data = fp.read(CHUNK_SIZE)
+        if not data:
+            break
+        yield data
+
+# a ZipInfo for member path, as ZipFile.writestr would make it
+def memberInfo(path):
+    zinfo = ZipInfo(path, time.localtime(time.time())[:6], compress_type=ZIP_DEFLATED)
+    zinfo.external_attr = 0600 << 16
+    zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+    return zinfo
+
+# Yield the data to store for the member zinfo, given the chunks of its
+# contents, compressed if zinfo asks for it. The CRC and sizes of zinfo
+# are set once the chunks run out.
+# With deflated the chunks are a raw deflate stream that is passed on as
+# it is, it is only inflated for its CRC and size. zlib.error is raised
+# if the stream does not end properly.
+def encodeChunks(zinfo, chunks, deflated=False):
+    crc = file_size = compress_size = 0
+    cmpr = dc = None
+    if deflated:
+        dc = zlib.decompressobj(-15)
+    elif zinfo.compress_type == ZIP_DEFLATED:
+        cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    for data in chunks:
+        if dc is not None:
+            compress_size += len(data)
+            yield data
+            while data:
+                bytes = dc.decompress(data, CHUNK_SIZE)
+                data = dc.unconsumed_tail
+                file_size += len(bytes)
+                crc = zlib.crc32(bytes, crc)
+        else:
+            file_size += len(data)
+            crc = zlib.crc32(data, crc)
+            if cmpr is not None:
+                data = cmpr.compress(data)
+            compress_size += len(data)
+            if data:
+                yield data
+    if cmpr is not None:
+        data = cmpr.flush()
+        compress_size += len(data)
+        yield data
+    if dc is not None:
+        # the last call can leave output behind, past the end of the
+        # stream the Z is left over
+        bytes = dc.decompress('Z') + dc.flush()
+        file_size += len(bytes)
+        crc = zlib.crc32(bytes, crc)
+        if not dc.unused_data:
+            raise zlib.error('incomplete deflate stream')
+    zinfo.CRC = crc & 0xffffffff
+    zinfo.file_size = file_size
+    zinfo.compress_size = compress_size
+
+# Add the member zinfo to the open ZipFile outf from the pieces of its
+# stored data. Written the way ZipFile.write writes a file: the local
+# header is rewritten once the pieces are written and zinfo has the
+# CRC and sizes. If the pieces raise an error nothing is added.
+def writeStream(outf, zinfo, chunks):
+    zinfo.flag_bits = 0x00
+    zinfo.header_offset = outf.fp.tell()
+    outf._writecheck(zinfo)
+    outf._didModify = True
+    outf.fp.write(zinfo.FileHeader(False))
+    try:
+        for data in chunks:
+            outf.fp.write(data)
+    except:
+        outf.fp.seek(zinfo.header_offset, 0)
+        outf.fp.truncate()
+        raise
+    position = outf.fp.tell()
+    outf.fp.seek(zinfo.header_offset, 0)
+    outf.fp.write(zinfo.FileHeader(False))
+    outf.fp.seek(position, 0)
+    outf.filelist.append(zinfo)
+    outf.NameToInfo[zinfo.filename] = zinfo
 
 
 class DecryptionDialog(Tkinter.Frame):
@@ -268,35 +480,72 @@ class DecryptionDialog(Tkinter.Frame):
         self.status['text'] = 'File successfully decrypted'
 
 
-def decryptBook(keypath, inpath, outpath):
+# The book key in rights, the element tree of META-INF/rights.xml,
+# decrypted with aes, made from the user key. None if the user key does
+# not fit the book, which shows in the padding of the decrypted key.
+def getBookKey(aes, rights):
+    adept = lambda tag: '{%s}%s' % (NSMAP['adept'], tag)
+    expr = './/%s' % (adept('encryptedKey'),)
+    bookkey = ''.join(rights.findtext(expr))
+    bookkey = aes.decrypt(bookkey.decode('base64'))
+    pad = ord(bookkey[-1:] or '\x00')
+    if pad < 1 or pad > 16 or bookkey[-pad:] != bookkey[-1] * pad \
+       or len(bookkey) < pad + 16:
+        return None
+    return bookkey[:-pad][-16:]
+
+# Check whether the user key in keypath fits the book in inpath. Only
+# META-INF/rights.xml is read, which is much quicker than trying to
+# decrypt the book.
+def probeKey(keypath, inpath):
+    with open(keypath, 'rb') as f:
+        keyb64 = f.read()
+    aes = AES(keyb64.decode('base64')[:16])
+    with closing(openBook(inpath)) as inf:
+        rights = etree.fromstring(inf.read('META-INF/rights.xml'))
+    return getBookKey(aes, rights) is not None
+
+# workers > 1 decrypts the book members with that many threads
+def decryptBook(keypath, inpath, outpath, workers=1):
     with open(keypath, 'rb') as f:
         keyb64 = f.read()
     key = keyb64.decode('base64')[:16]
     # aes = AES.new(key, AES.MODE_CBC, '\x00'*16)
     aes = AES(key)
 
-    with closing(ZipFile(open(inpath, 'rb'))) as inf:
+    with closing(openBook(inpath)) as inf:
         namelist = set(inf.namelist())
         if 'META-INF/rights.xml' not in namelist or \
            'META-INF/encryption.xml' not in namelist:
             raise IGNOBLEError('%s: not an B&N ADEPT EPUB' % (inpath,))
-        for name in META_NAMES:
-            namelist.remove(name)
         rights = etree.fromstring(inf.read('META-INF/rights.xml'))
-        adept = lambda tag: '{%s}%s' % (NSMAP['adept'], tag)
-        expr = './/%s' % (adept('encryptedKey'),)
-        bookkey = ''.join(rights.findtext(expr))
-        bookkey = aes.decrypt(bookkey.decode('base64'))
-        bookkey = bookkey[:-ord(bookkey[-1])]
+        bookkey = getBookKey(aes, rights)
+        if bookkey is None:
+            raise IGNOBLEError('problem decrypting session key')
         encryption = inf.read('META-INF/encryption.xml')
-        decryptor = Decryptor(bookkey[-16:], encryption)
+        decryptor = Decryptor(bookkey, encryption)
         kwds = dict(compression=ZIP_DEFLATED, allowZip64=False)
         with closing(ZipFile(open(outpath, 'wb'), 'w', **kwds)) as outf:
             zi = ZipInfo('mimetype', compress_type=ZIP_STORED)
             outf.writestr(zi, inf.read('mimetype'))
-            for path in namelist:
-                data = inf.read(path)
-                outf.writestr(path, decryptor.decrypt(path, data))
+            names = [name for name in inf.namelist() if name not in META_NAMES]
+            decryptor.writeMembers(inf, outf, names, workers)
+    return 0
+
+
+# time the decryption of a book with different numbers of workers
+def benchmark(keypath, inpath, count=3):
+    import tempfile
+    fd, outpath = tempfile.mkstemp('.epub')
+    os.close(fd)
+    try:
+        for workers in (1, 2, 4, 8):
+            start = time.time()
+            for i in xrange(count):
+                decryptBook(keypath, inpath, outpath, workers)
+            print '%d workers: %.2f s per book' % (workers, (time.time() - start) / count)
+    finally:
+        os.remove(outpath)
     return 0
 
 
@@ -307,11 +556,26 @@ def cli_main(argv=sys.argv):
               "separately.  Read the top-of-script comment for details." % \
               (progname,)
         return 1
-    if len(argv) != 4:
-        print "usage: %s KEYFILE INBOOK OUTBOOK" % (progname,)
+    try:
+        opts, args = getopt.getopt(argv[1:], "w:", ["workers=", "benchmark"])
+    except getopt.GetoptError, err:
+        print str(err)
+        opts, args = [], []
+    workers = 1
+    timeit = False
+    for o, a in opts:
+        if o in ("-w", "--workers"):
+            workers = int(a)
+        if o == "--benchmark":
+            timeit = True
+    if timeit and len(args) == 2:
+        return benchmark(*args)
+    if len(args) != 3:
+        print "usage: %s [-w WORKERS] KEYFILE INBOOK OUTBOOK" % (progname,)
+        print "       %s --benchmark KEYFILE INBOOK" % (progname,)
         return 1
-    keypath, inpath, outpath = argv[1:]
-    return decryptBook(keypath, inpath, outpath)
+    keypath, inpath, outpath = args
+    return decryptBook(keypath, inpath, outpath, workers)
 
 
 def gui_main():
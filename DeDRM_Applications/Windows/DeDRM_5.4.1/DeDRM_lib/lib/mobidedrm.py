@@ -59,9 +59,14 @@
 #  0.35 - add interface to get mobi_version
 #  0.36 - fixed problem with TEXtREAd and getBookTitle interface
 #  0.37 - Fixed double announcement for stand-alone operation
+#  0.38 - Memory map the input file and keep header patches as an overlay
+#         that is only applied when the output is built
+#  0.39 - Added processBookTo to stream the decrypted book to an open file
+#  0.40 - Optional decryption of records in parallel across several processes
+#  0.41 - Use the shared palmdb reader for the section table
 
 
-__version__ = '0.37'
+__version__ = '0.41'
 
 import sys
 
@@ -78,11 +83,21 @@ sys.stdout=Unbuffered(sys.stdout)
 import os
 import struct
 import binascii
+import time
 from alfcrypto import Pukall_Cipher
+from palmdb import PalmDB
 
 class DrmException(Exception):
     pass
 
+# size of the pieces used when copying unencrypted data to the output
+COPY_CHUNK = 0x100000
+
+# books with fewer text records than this are always decrypted serially
+PARALLEL_MIN_RECORDS = 256
+# number of records handed to a worker process at a time
+PARALLEL_BATCH = 64
+
 
 #
 # MobiBook Utility Routines
@@ -160,16 +175,37 @@ def getSizeOfTrailingDataEntries(ptr, size, flags):
         num += (ord(ptr[size - num - 1]) & 0x3) + 1
     return num
 
+# Decrypt a batch of records in a worker process. The worker maps the book
+# itself so that only record numbers and the decrypted output cross processes.
+def decryptRecords(args):
+    infile, key, extra_data_flags, first, last = args
+    pdb = PalmDB(infile)
+    result = []
+    try:
+        for i in xrange(first, last):
+            data = pdb.loadSection(i)
+            extra_size = getSizeOfTrailingDataEntries(data, len(data), extra_data_flags)
+            result.append((PC1(key, data[0:len(data) - extra_size]), data[len(data) - extra_size:]))
+    finally:
+        pdb.close()
+    return result
+
 
 
 class MobiBook:
     def loadSection(self, section):
-        if (section + 1 == self.num_sections):
-            endoff = len(self.data_file)
-        else:
-            endoff = self.sections[section + 1][0]
-        off = self.sections[section][0]
-        return self.data_file[off:endoff]
+        off, endoff = self.pdb.sectionRange(section)
+        return self.readData(off, endoff)
+
+    # return data_file[start:end] with any pending patches applied
+    def readData(self, start, end):
+        data = self.data_file[start:end]
+        for off, new in self.patches:
+            lo = max(off, start)
+            hi = min(off + len(new), end)
+            if lo < hi:
+                data = data[:lo-start] + new[lo-off:hi-off] + data[hi-start:]
+        return data
 
     def __init__(self, infile, announce = True):
         if announce:
@@ -177,21 +213,23 @@ class MobiBook:
                'Copyright 2008-2012 The Dark Reverser et al.' % globals())
 
         # initial sanity check on file
-        self.data_file = file(infile, 'rb').read()
+        # the book is memory mapped rather than read in, and patches are
+        # kept as (offset, data) pairs until the output is built
+        self.infile = infile
+        try:
+            self.pdb = PalmDB(infile)
+        except ValueError:
+            raise DrmException("invalid file format")
+        self.data_file = self.pdb.data
+        self.patches = []
         self.mobi_data = ''
-        self.header = self.data_file[0:78]
-        if self.header[0x3C:0x3C+8] != 'BOOKMOBI' and self.header[0x3C:0x3C+8] != 'TEXtREAd':
+        self.header = self.pdb.header
+        if self.pdb.ident != 'BOOKMOBI' and self.pdb.ident != 'TEXtREAd':
+            self.pdb.close()
             raise DrmException("invalid file format")
-        self.magic = self.header[0x3C:0x3C+8]
+        self.magic = self.pdb.ident
         self.crypto_type = -1
-
-        # build up section offset and flag info
-        self.num_sections, = struct.unpack('>H', self.header[76:78])
-        self.sections = []
-        for i in xrange(self.num_sections):
-            offset, a1,a2,a3,a4 = struct.unpack('>LBBBB', self.data_file[78+i*8:78+i*8+8])
-            flags, val = a1, a2<<16|a3<<8|a4
-            self.sections.append( (offset, flags, val) )
+        self.num_sections = self.pdb.num_sections
 
         # parse information from section 0
         self.sect = self.loadSection(0)
@@ -284,14 +322,10 @@ class MobiBook:
         return rec209, token
 
     def patch(self, off, new):
-        self.data_file = self.data_file[:off] + new + self.data_file[off+len(new):]
+        self.patches.append((off, new))
 
     def patchSection(self, section, new, in_off = 0):
-        if (section + 1 == self.num_sections):
-            endoff = len(self.data_file)
-        else:
-            endoff = self.sections[section + 1][0]
-        off = self.sections[section][0]
+        off, endoff = self.pdb.sectionRange(section)
         assert off + in_off + len(new) <= endoff
         self.patch(off + in_off, new)
 
@@ -331,13 +365,77 @@ class MobiBook:
     def getMobiFile(self, outpath):
         file(outpath,'wb').write(self.mobi_data)
 
+    def cleanup(self):
+        self.pdb.close()
+
     def getMobiVersion(self):
         return self.mobi_version
 
     def getPrintReplica(self):
         return self.print_replica
 
-    def processBook(self, pidlist):
+    # copy data_file[start:end], with patches applied, in bounded pieces
+    def copyData(self, write, start, end):
+        while start < end:
+            stop = min(start + COPY_CHUNK, end)
+            write(self.readData(start, stop))
+            start = stop
+
+    # decrypt records 1 to self.records in order, one at a time
+    def decryptSerial(self, write, found_key):
+        for i in xrange(1, self.records+1):
+            data = self.loadSection(i)
+            extra_size = getSizeOfTrailingDataEntries(data, len(data), self.extra_data_flags)
+            if i%100 == 0:
+                print ".",
+            # print "record %d, extra_size %d" %(i,extra_size)
+            decoded_data = PC1(found_key, data[0:len(data) - extra_size])
+            if i==1:
+                self.print_replica = (decoded_data[0:4] == '%MOP')
+            write(decoded_data)
+            if extra_size > 0:
+                write(data[-extra_size:])
+
+    # decrypt the same records with a pool of worker processes, writing
+    # the results in record order
+    def decryptParallel(self, write, found_key, jobs):
+        import multiprocessing
+        batches = []
+        for first in xrange(1, self.records+1, PARALLEL_BATCH):
+            last = min(first + PARALLEL_BATCH, self.records+1)
+            batches.append((self.infile, found_key, self.extra_data_flags, first, last))
+        pool = multiprocessing.Pool(jobs)
+        try:
+            first = True
+            for result in pool.imap(decryptRecords, batches):
+                for decoded_data, extra_data in result:
+                    if first:
+                        self.print_replica = (decoded_data[0:4] == '%MOP')
+                        first = False
+                    write(decoded_data)
+                    if extra_data:
+                        write(extra_data)
+                print ".",
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def processBook(self, pidlist, jobs=1):
+        mobidataList = []
+        self.writeBook(mobidataList.append, pidlist, jobs)
+        self.mobi_data = "".join(mobidataList)
+
+    # decrypt straight to an open output file so the whole book is
+    # never held in memory
+    def processBookTo(self, outfile, pidlist, jobs=1):
+        self.writeBook(outfile.write, pidlist, jobs)
+
+    # jobs > 1 decrypts the records with that many worker processes,
+    # but only for books with at least PARALLEL_MIN_RECORDS records
+    def writeBook(self, write, pidlist, jobs=1):
         crypto_type, = struct.unpack('>H', self.sect[0xC:0xC+2])
         print 'Crypto Type is: ', crypto_type
         self.crypto_type = crypto_type
@@ -345,7 +443,7 @@ class MobiBook:
             print "This book is not encrypted."
             # we must still check for Print Replica
             self.print_replica = (self.loadSection(1)[0:4] == '%MOP')
-            self.mobi_data = self.data_file
+            self.copyData(write, 0, len(self.data_file))
             return
         if crypto_type != 2 and crypto_type != 1:
             raise DrmException("Cannot decode unknown Mobipocket encryption type %d" % crypto_type)
@@ -397,23 +495,16 @@ class MobiBook:
 
         # decrypt sections
         print "Decrypting. Please wait . . .",
-        mobidataList = []
-        mobidataList.append(self.data_file[:self.sections[1][0]])
-        for i in xrange(1, self.records+1):
-            data = self.loadSection(i)
-            extra_size = getSizeOfTrailingDataEntries(data, len(data), self.extra_data_flags)
-            if i%100 == 0:
-                print ".",
-            # print "record %d, extra_size %d" %(i,extra_size)
-            decoded_data = PC1(found_key, data[0:len(data) - extra_size])
-            if i==1:
-                self.print_replica = (decoded_data[0:4] == '%MOP')
-            mobidataList.append(decoded_data)
-            if extra_size > 0:
-                mobidataList.append(data[-extra_size:])
+        write(self.readData(0, self.pdb.offsets[1]))
+        starttime = time.time()
+        if jobs > 1 and self.records >= PARALLEL_MIN_RECORDS:
+            self.decryptParallel(write, found_key, jobs)
+        else:
+            self.decryptSerial(write, found_key)
+        elapsed = max(time.time() - starttime, 0.001)
         if self.num_sections > self.records+1:
-            mobidataList.append(self.data_file[self.sections[self.records+1][0]:])
-        self.mobi_data = "".join(mobidataList)
+            self.copyData(write, self.pdb.offsets[self.records+1], len(self.data_file))
+        print "(%d records, %.0f records/s)" % (self.records, self.records / elapsed),
         print "done"
         return
 
@@ -421,14 +512,20 @@ def getUnencryptedBook(infile,pid,announce=True):
     if not os.path.isfile(infile):
         raise DrmException('Input File Not Found')
     book = MobiBook(infile,announce)
-    book.processBook([pid])
+    try:
+        book.processBook([pid])
+    finally:
+        book.cleanup()
     return book.mobi_data
 
 def getUnencryptedBookWithList(infile,pidlist,announce=True):
     if not os.path.isfile(infile):
         raise DrmException('Input File Not Found')
     book = MobiBook(infile, announce)
-    book.processBook(pidlist)
+    try:
+        book.processBook(pidlist)
+    finally:
+        book.cleanup()
     return book.mobi_data
 
 
@@ -447,12 +544,25 @@ def main(argv=sys.argv):
             pidlist = argv[3].split(',')
         else:
             pidlist = {}
+        if not os.path.isfile(infile):
+            print "Error: Input File Not Found"
+            return 1
+        try:
+            book = MobiBook(infile, False)
+        except DrmException, e:
+            print "Error: %s" % e
+            return 1
+        outf = file(outfile, 'wb')
         try:
-            stripped_file = getUnencryptedBookWithList(infile, pidlist, False)
-            file(outfile, 'wb').write(stripped_file)
+            book.processBookTo(outf, pidlist)
         except DrmException, e:
+            outf.close()
+            book.cleanup()
+            os.remove(outfile)
             print "Error: %s" % e
             return 1
+        outf.close()
+        book.cleanup()
     return 0
 
 
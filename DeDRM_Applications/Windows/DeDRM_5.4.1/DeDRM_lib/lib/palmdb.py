@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# palmdb.py
+# Shared reader for Palm database (PDB) files: Mobipocket, Kindle and
+# eReader books all use this container.
+#
+# The file is memory mapped and the section table is parsed in one go,
+# so opening a book to look at its header only touches the pages that
+# are actually read. Sections are read on demand, either as a copy
+# (loadSection) or as a zero-copy view into the mapping (sectionView).
+#
+# Changelog
+#  1.00 - Initial version
+
+__version__ = '1.00'
+
+import struct
+import mmap
+from array import array
+
+# typecode of a 32 bit unsigned array on this platform
+if array('I').itemsize == 4:
+    UINT32 = 'I'
+else:
+    UINT32 = 'L'
+
+class PalmDB(object):
+    # important palmdb header offsets
+    unique_id_seed = 68
+    number_of_pdb_records = 76
+    first_pdb_record = 78
+
+    # pass either the name of the file to map, or its contents as a string
+    def __init__(self, filename=None, data=None):
+        self.infile = None
+        if data is None:
+            self.infile = file(filename, 'rb')
+            try:
+                data = mmap.mmap(self.infile.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                self.infile.close()
+                raise ValueError('Invalid file format')
+        self.data = data
+        if len(data) < PalmDB.first_pdb_record:
+            self.close()
+            raise ValueError('Invalid file format')
+        self.header = data[0:PalmDB.first_pdb_record]
+        self.ident = self.header[0x3C:0x3C+8]
+        self.num_sections, = struct.unpack_from('>H', self.header, PalmDB.number_of_pdb_records)
+        if len(data) < PalmDB.first_pdb_record + 8 * self.num_sections:
+            self.close()
+            raise ValueError('Invalid file format')
+        # each entry is the section offset followed by its attributes
+        # (flags in the top byte, unique id in the low three bytes)
+        table = struct.unpack_from('>%dL' % (2 * self.num_sections), data, PalmDB.first_pdb_record)
+        self.offsets = array(UINT32, table[0::2])
+        self.attributes = array(UINT32, table[1::2])
+
+    def getNumSections(self):
+        return self.num_sections
+
+    def sectionRange(self, section):
+        if section + 1 == self.num_sections:
+            endoff = len(self.data)
+        else:
+            endoff = self.offsets[section + 1]
+        return self.offsets[section], endoff
+
+    def sectionFlags(self, section):
+        attr = self.attributes[section]
+        return attr >> 24, attr & 0xFFFFFF
+
+    def loadSection(self, section):
+        if section >= self.num_sections:
+            return ''
+        off, endoff = self.sectionRange(section)
+        return self.data[off:endoff]
+
+    # zero-copy view of a section, for writing it out or for struct.unpack_from
+    def sectionView(self, section):
+        if section >= self.num_sections:
+            return buffer('')
+        off, endoff = self.sectionRange(section)
+        return buffer(self.data, off, endoff - off)
+
+    def close(self):
+        if self.infile is not None:
+            self.data.close()
+            self.infile.close()
+            self.infile = None
@@ -18,8 +18,19 @@ else:
 
 buildXML = False
 
+# keep the decrypted records in the temporary directory instead of memory
+spillRecords = False
+
+# number of threads decrypting and decompressing the book records,
+# and compressing the archive members
+EXTRACT_THREADS = 4
+# smaller books are extracted and archived on the calling thread only
+THREADED_MIN_SIZE = 0x400000
+
 import os, csv, getopt
 import zlib, zipfile, tempfile, shutil
+import mmap
+import itertools
 from struct import pack
 from struct import unpack
 from alfcrypto import Topaz_Cipher
@@ -31,49 +42,61 @@ class TpzDRMError(Exception):
 # local support routines
 if inCalibre:
     from calibre_plugins.k4mobidedrm import kgenpids
+    from calibre_plugins.k4mobidedrm import topazrecords
+    from calibre_plugins.k4mobidedrm import zipwriter
 else:
     import kgenpids
+    import topazrecords
+    import zipwriter
 
-# recursive zip creation support routine
-def zipUpDir(myzip, tdir, localname):
+# recursive zip creation support routine, yields (name in zip, contents)
+# for each file below tdir/localname
+def dirMembers(tdir, localname):
     currentdir = tdir
     if localname != "":
         currentdir = os.path.join(currentdir,localname)
     list = os.listdir(currentdir)
-    for file in list:
-        afilename = file
+    for afilename in list:
         localfilePath = os.path.join(localname, afilename)
-        realfilePath = os.path.join(currentdir,file)
+        realfilePath = os.path.join(currentdir,afilename)
         if os.path.isfile(realfilePath):
-            myzip.write(realfilePath, localfilePath)
+            yield localfilePath.replace(os.sep, '/'), file(realfilePath, 'rb').read()
         elif os.path.isdir(realfilePath):
-            zipUpDir(myzip, tdir, localfilePath)
+            for member in dirMembers(tdir, localfilePath):
+                yield member
 
 #
 # Utility routines
 #
 
-# Get a 7 bit encoded number from file
-def bookReadEncodedNumber(fo):
+# Get a 7 bit encoded number from the book data at pos,
+# returns the number and the position after it
+def bookReadEncodedNumber(book, pos):
     flag = False
-    data = ord(fo.read(1))
+    data = ord(book[pos])
+    pos += 1
     if data == 0xFF:
         flag = True
-        data = ord(fo.read(1))
+        data = ord(book[pos])
+        pos += 1
     if data >= 0x80:
         datax = (data & 0x7F)
         while data >= 0x80 :
-            data = ord(fo.read(1))
+            data = ord(book[pos])
+            pos += 1
             datax = (datax <<7) + (data & 0x7F)
         data = datax
     if flag:
         data = -data
-    return data
+    return data, pos
 
-# Get a length prefixed string from file
-def bookReadString(fo):
-    stringLength = bookReadEncodedNumber(fo)
-    return unpack(str(stringLength)+"s",fo.read(stringLength))[0]
+# Get a length prefixed string from the book data at pos,
+# returns the string and the position after it
+def bookReadString(book, pos):
+    stringLength, pos = bookReadEncodedNumber(book, pos)
+    if pos + stringLength > len(book):
+        raise TpzDRMError("Parse Error : String runs past the end of the book")
+    return book[pos:pos+stringLength], pos + stringLength
 
 #
 # crypto routines
@@ -141,57 +164,66 @@ def decryptDkeyRecords(data,PID):
 
 class TopazBook:
     def __init__(self, filename):
+        # the book is memory mapped, records are read straight out of it
         self.fo = file(filename, 'rb')
+        try:
+            self.data = mmap.mmap(self.fo.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            self.fo.close()
+            raise TpzDRMError("Parse Error : Invalid Header, not a Topaz file")
         self.outdir = tempfile.mkdtemp()
         # self.outdir = 'rawdat'
+        self.records = None
         self.bookPayloadOffset = 0
         self.bookHeaderRecords = {}
         self.bookMetadata = {}
         self.bookKey = None
-        magic = unpack("4s",self.fo.read(4))[0]
+        self.bookKeyCtx = None
+        self.imageMembers = None
+        self.archiveThreads = 1
+        if len(self.data) >= THREADED_MIN_SIZE:
+            self.archiveThreads = EXTRACT_THREADS
+        magic = self.data[0:4]
         if magic != 'TPZ0':
             raise TpzDRMError("Parse Error : Invalid Header, not a Topaz file")
         self.parseTopazHeaders()
         self.parseMetadata()
 
     def parseTopazHeaders(self):
-        def bookReadHeaderRecordData():
-            # Read and return the data of one header record at the current book file position
-            # [[offset,decompressedLength,compressedLength],...]
-            nbValues = bookReadEncodedNumber(self.fo)
-            values = []
-            for i in range (0,nbValues):
-                values.append([bookReadEncodedNumber(self.fo),bookReadEncodedNumber(self.fo),bookReadEncodedNumber(self.fo)])
-            return values
-        def parseTopazHeaderRecord():
-            # Read and parse one header record at the current book file position and return the associated data
-            # [[offset,decompressedLength,compressedLength],...]
-            if ord(self.fo.read(1)) != 0x63:
-                raise TpzDRMError("Parse Error : Invalid Header")
-            tag = bookReadString(self.fo)
-            record = bookReadHeaderRecordData()
-            return [tag,record]
-        nbRecords = bookReadEncodedNumber(self.fo)
+        # Read the header records following the magic, each one is
+        # [tag, [[offset,decompressedLength,compressedLength],...]]
+        book = self.data
+        nbRecords, pos = bookReadEncodedNumber(book, 4)
         for i in range (0,nbRecords):
-            result = parseTopazHeaderRecord()
-            # print result[0], result[1]
-            self.bookHeaderRecords[result[0]] = result[1]
-        if ord(self.fo.read(1))  != 0x64 :
+            if ord(book[pos]) != 0x63:
+                raise TpzDRMError("Parse Error : Invalid Header")
+            tag, pos = bookReadString(book, pos + 1)
+            nbValues, pos = bookReadEncodedNumber(book, pos)
+            values = []
+            for j in range (0,nbValues):
+                offset, pos = bookReadEncodedNumber(book, pos)
+                decompressedLength, pos = bookReadEncodedNumber(book, pos)
+                compressedLength, pos = bookReadEncodedNumber(book, pos)
+                values.append([offset,decompressedLength,compressedLength])
+            # print tag, values
+            self.bookHeaderRecords[tag] = values
+        if ord(book[pos])  != 0x64 :
             raise TpzDRMError("Parse Error : Invalid Header")
-        self.bookPayloadOffset = self.fo.tell()
+        self.bookPayloadOffset = pos + 1
 
     def parseMetadata(self):
         # Parse the metadata record from the book payload and return a list of [key,values]
-        self.fo.seek(self.bookPayloadOffset + self.bookHeaderRecords["metadata"][0][0])
-        tag = bookReadString(self.fo)
+        book = self.data
+        tag, pos = bookReadString(book, self.bookPayloadOffset + self.bookHeaderRecords["metadata"][0][0])
         if tag != "metadata" :
             raise TpzDRMError("Parse Error : Record Names Don't Match")
-        flags = ord(self.fo.read(1))
-        nbRecords = ord(self.fo.read(1))
+        flags = ord(book[pos])
+        nbRecords = ord(book[pos + 1])
+        pos += 2
         # print nbRecords
         for i in range (0,nbRecords) :
-            keyval = bookReadString(self.fo)
-            content = bookReadString(self.fo)
+            keyval, pos = bookReadString(book, pos)
+            content, pos = bookReadString(book, pos)
             # print keyval
             # print content
             self.bookMetadata[keyval] = content
@@ -212,26 +244,27 @@ class TopazBook:
             title = self.bookMetadata['Title']
         return title
 
+    # the cipher context depends only on the key, so it is set up once
     def setBookKey(self, key):
         self.bookKey = key
+        self.bookKeyCtx = topazCryptoInit(key)
 
-    def getBookPayloadRecord(self, name, index):
-        # Get a record in the book payload, given its name and index.
-        # decrypted and decompressed if necessary
+    def getBookPayloadView(self, name, index):
+        # Locate a record in the book payload, given its name and index.
+        # Returns a zero-copy view of its stored data and whether it is
+        # encrypted and compressed
         encrypted = False
         compressed = False
         try:
-            recordOffset = self.bookHeaderRecords[name][index][0]
+            (recordOffset, decompressedLength, compressedLength) = self.bookHeaderRecords[name][index]
         except:
             raise TpzDRMError("Parse Error : Invalid Record, record not found")
 
-        self.fo.seek(self.bookPayloadOffset + recordOffset)
-
-        tag = bookReadString(self.fo)
+        tag, pos = bookReadString(self.data, self.bookPayloadOffset + recordOffset)
         if tag != name :
             raise TpzDRMError("Parse Error : Invalid Record, record name doesn't match")
 
-        recordIndex = bookReadEncodedNumber(self.fo)
+        recordIndex, pos = bookReadEncodedNumber(self.data, pos)
         if recordIndex < 0 :
             encrypted = True
             recordIndex = -recordIndex -1
@@ -239,25 +272,38 @@ class TopazBook:
         if recordIndex != index :
             raise TpzDRMError("Parse Error : Invalid Record, index doesn't match")
 
-        if (self.bookHeaderRecords[name][index][2] > 0):
+        if (compressedLength > 0):
             compressed = True
-            record = self.fo.read(self.bookHeaderRecords[name][index][2])
+            length = compressedLength
         else:
-            record = self.fo.read(self.bookHeaderRecords[name][index][1])
+            length = decompressedLength
+        length = max(0, min(length, len(self.data) - pos))
+
+        return buffer(self.data, pos, length), encrypted, compressed
+
+    # decrypt and decompress a record located by getBookPayloadView,
+    # safe to run on several threads at once
+    def decodeBookPayloadRecord(self, location):
+        record, encrypted, compressed = location
 
         if encrypted:
             if self.bookKey:
-                ctx = topazCryptoInit(self.bookKey)
-                record = topazCryptoDecrypt(record,ctx)
+                record = topazCryptoDecrypt(str(record),self.bookKeyCtx)
             else :
                 raise TpzDRMError("Error: Attempt to decrypt without bookKey")
 
         if compressed:
             record = zlib.decompress(record)
 
-        return record
+        return str(record)
+
+    def getBookPayloadRecord(self, name, index):
+        # Get a record in the book payload, given its name and index.
+        # decrypted and decompressed if necessary
+        return self.decodeBookPayloadRecord(self.getBookPayloadView(name, index))
 
-    def processBook(self, pidlst):
+    # jobs > 1 renders the book pages with that many worker processes
+    def processBook(self, pidlst, jobs=1):
         raw = 0
         fixedimage=True
         try:
@@ -273,7 +319,7 @@ class TopazBook:
             else:
                 import genbook
 
-            rv = genbook.generateBook(self.outdir, raw, fixedimage)
+            rv = genbook.generateBook(self.outdir, raw, fixedimage, self.records, jobs)
             if rv == 0:
                 print "\nBook Successfully generated"
             return rv
@@ -307,102 +353,125 @@ class TopazBook:
         else:
             import genbook
 
-        rv = genbook.generateBook(self.outdir, raw, fixedimage)
+        rv = genbook.generateBook(self.outdir, raw, fixedimage, self.records, jobs)
         if rv == 0:
             print "\nBook Successfully generated"
         return rv
 
     def createBookDirectory(self):
         outdir = self.outdir
-        # create output directory structure
+        # create output directory and the store for the book records
         if not os.path.exists(outdir):
             os.makedirs(outdir)
-        destdir =  os.path.join(outdir,'img')
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        destdir =  os.path.join(outdir,'color_img')
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        destdir =  os.path.join(outdir,'page')
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        destdir =  os.path.join(outdir,'glyphs')
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-
+        spilldir = None
+        if spillRecords:
+            spilldir = os.path.join(outdir,'records')
+        self.records = topazrecords.TopazRecords(spilldir)
+
+    # The records of larger books are decrypted and decompressed on a
+    # pool of threads, the native cipher and zlib both let the other
+    # threads run
     def extractFiles(self):
-        outdir = self.outdir
-        for headerRecord in self.bookHeaderRecords:
-            name = headerRecord
-            if name != "dkey" :
-                ext = '.dat'
-                if name == 'img' : ext = '.jpg'
-                if name == 'color' : ext = '.jpg'
-                print "\nProcessing Section: %s " % name
-                for index in range (0,len(self.bookHeaderRecords[name])) :
-                    fnum = "%04d" % index
-                    fname = name + fnum + ext
-                    destdir = outdir
-                    if name == 'img':
-                        destdir =  os.path.join(outdir,'img')
-                    if name == 'color':
-                        destdir =  os.path.join(outdir,'color_img')
-                    if name == 'page':
-                        destdir =  os.path.join(outdir,'page')
-                    if name == 'glyphs':
-                        destdir =  os.path.join(outdir,'glyphs')
-                    outputFile = os.path.join(destdir,fname)
-                    print ".",
-                    record = self.getBookPayloadRecord(name,index)
-                    if record != '':
-                        file(outputFile, 'wb').write(record)
+        pool = None
+        decode = itertools.imap
+        if EXTRACT_THREADS > 1 and len(self.data) >= THREADED_MIN_SIZE:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(EXTRACT_THREADS)
+            decode = pool.imap
+        try:
+            for headerRecord in self.bookHeaderRecords:
+                name = headerRecord
+                if name != "dkey" :
+                    print "\nProcessing Section: %s " % name
+                    locations = [self.getBookPayloadView(name,index) for index in range (0,len(self.bookHeaderRecords[name]))]
+                    for index, record in enumerate(decode(self.decodeBookPayloadRecord, locations)):
+                        print ".",
+                        if record != '':
+                            self.records.addRecord(name, index, record)
+            if pool is not None:
+                pool.close()
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.join()
         print " "
 
+    # The archive members for the image records and the svg images made
+    # by genbook. They are compressed once and shared by all the
+    # archives, the jpeg records are stored as they are.
+    def getImageMembers(self):
+        if self.imageMembers is None:
+            images = []
+            for index in self.records.getIndices('img'):
+                fname = self.records.getFileName('img', index)
+                images.append(('img/' + fname, self.records.getRecord('img', index)))
+            images = itertools.chain(images, dirMembers(self.outdir, 'img'))
+            self.imageMembers = list(zipwriter.compressMembers(images, self.archiveThreads))
+        return self.imageMembers
+
+    # write an archive from (name, contents) members and the images
+    def writeArchive(self, zipname, members):
+        myzip = zipfile.ZipFile(zipname,'w',zipfile.ZIP_DEFLATED, False)
+        for member in zipwriter.compressMembers(members, self.archiveThreads):
+            zipwriter.writeMember(myzip, member)
+        for member in self.getImageMembers():
+            zipwriter.writeMember(myzip, member)
+        myzip.close()
+
+    # (name, contents) of the named files in the book directory
+    def fileMembers(self, names):
+        for name in names:
+            yield name, file(os.path.join(self.outdir,name), 'rb').read()
+
     def getHTMLZip(self, zipname):
-        htmlzip = zipfile.ZipFile(zipname,'w',zipfile.ZIP_DEFLATED, False)
-        htmlzip.write(os.path.join(self.outdir,'book.html'),'book.html')
-        htmlzip.write(os.path.join(self.outdir,'book.opf'),'book.opf')
-        if os.path.isfile(os.path.join(self.outdir,'cover.jpg')):
-            htmlzip.write(os.path.join(self.outdir,'cover.jpg'),'cover.jpg')
-        htmlzip.write(os.path.join(self.outdir,'style.css'),'style.css')
-        zipUpDir(htmlzip, self.outdir, 'img')
-        htmlzip.close()
+        members = self.fileMembers(['book.html', 'book.opf'])
+        # genbook makes cover.jpg from the first image record
+        if self.records.hasRecord('img', 0):
+            cover = [('cover.jpg', self.records.getRecord('img', 0))]
+            members = itertools.chain(members, cover)
+        members = itertools.chain(members, self.fileMembers(['style.css']))
+        self.writeArchive(zipname, members)
 
     def getSVGZip(self, zipname):
-        svgzip = zipfile.ZipFile(zipname,'w',zipfile.ZIP_DEFLATED, False)
-        svgzip.write(os.path.join(self.outdir,'index_svg.xhtml'),'index_svg.xhtml')
-        zipUpDir(svgzip, self.outdir, 'svg')
-        zipUpDir(svgzip, self.outdir, 'img')
-        svgzip.close()
+        members = itertools.chain(self.fileMembers(['index_svg.xhtml']), dirMembers(self.outdir, 'svg'))
+        self.writeArchive(zipname, members)
 
     def getXMLZip(self, zipname):
-        xmlzip = zipfile.ZipFile(zipname,'w',zipfile.ZIP_DEFLATED, False)
         targetdir = os.path.join(self.outdir,'xml')
-        zipUpDir(xmlzip, targetdir, '')
-        zipUpDir(xmlzip, self.outdir, 'img')
-        xmlzip.close()
+        self.writeArchive(zipname, dirMembers(targetdir, ''))
 
     def cleanup(self):
+        if self.data is not None:
+            self.data.close()
+            self.fo.close()
+            self.data = None
         if os.path.isdir(self.outdir):
             shutil.rmtree(self.outdir, True)
 
 def usage(progname):
     print "Removes DRM protection from Topaz ebooks and extract the contents"
     print "Usage:"
-    print "    %s [-k <kindle.info>] [-p <pidnums>] [-s <kindleSerialNumbers>] <infile> <outdir>  " % progname
+    print "    %s [-k <kindle.info>] [-p <pidnums>] [-s <kindleSerialNumbers>] [-j <jobs>] [--spill] <infile> <outdir>  " % progname
+    print "    --jobs (-j) renders the book pages using several processes at once"
+    print "    --spill keeps the decrypted book records on disk instead of in memory"
 
 
 # Main
 def main(argv=sys.argv):
     global buildXML
+    global spillRecords
     progname = os.path.basename(argv[0])
     k4 = False
     pids = []
     serials = []
     kInfoFiles = []
+    jobs = 1
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "k:p:s:")
+        opts, args = getopt.getopt(sys.argv[1:], "k:p:s:j:", ["jobs=", "spill"])
     except getopt.GetoptError, err:
         print str(err)
         usage(progname)
@@ -427,6 +496,14 @@ def main(argv=sys.argv):
                 print "Invalid parameter for -s"
                 return 1
             serials = a.split(',')
+        if o in ("-j", "--jobs"):
+            try:
+                jobs = int(a)
+            except ValueError:
+                print "Invalid parameter for --jobs"
+                return 1
+        if o == "--spill":
+            spillRecords = True
     k4 = True
 
     infile = args[0]
@@ -446,7 +523,7 @@ def main(argv=sys.argv):
 
     try:
         print "Decrypting Book"
-        tb.processBook(pids)
+        tb.processBook(pids, jobs)
 
         print "   Creating HTML ZIP Archive"
         zipname = os.path.join(outdir, bookname + '_nodrm' + '.htmlz')
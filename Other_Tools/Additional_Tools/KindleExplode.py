@@ -19,6 +19,9 @@ sys.stdout=Unbuffered(sys.stdout)
 import os, getopt, struct
 import imghdr
 
+sys.path.append(os.path.join(sys.path[0], 'lib'))
+from palmdb import PalmDB
+
 def sortedHeaderKeys(mheader):
     hdrkeys = sorted(mheader.keys(), key=lambda akey: mheader[akey][0])
     return hdrkeys
@@ -26,35 +29,6 @@ def sortedHeaderKeys(mheader):
 class dumpHeaderException(Exception):
     pass
 
-class PalmDB:
-    # important  palmdb header offsets
-    unique_id_seed = 68
-    number_of_pdb_records = 76
-    first_pdb_record = 78
-
-    def __init__(self, palmdata):
-        self.data = palmdata
-        self.nsec, = struct.unpack_from('>H',self.data,PalmDB.number_of_pdb_records)
-
-    def getsecaddr(self,secno):
-        secstart, = struct.unpack_from('>L', self.data, PalmDB.first_pdb_record+secno*8)
-        if secno == self.nsec-1:
-            secend = len(self.data)
-        else:
-            secend, = struct.unpack_from('>L',self.data,PalmDB.first_pdb_record+(secno+1)*8)
-        return secstart,secend
-
-    def readsection(self,secno):
-        if secno < self.nsec:
-            secstart, secend = self.getsecaddr(secno)
-            return self.data[secstart:secend]
-        return ''
-
-    def getnumsections(self):
-        return self.nsec
-
-
-
 class HdrParser:
     # all values are packed in big endian format
     mobi6_header = {
@@ -407,16 +381,17 @@ def main(argv=sys.argv):
 
     try:
         # make sure it is really a mobi ebook
-        mobidata = file(infile, 'rb').read()
-        palmheader = mobidata[0:78]
-        ident = palmheader[0x3C:0x3C+8]
-        if ident != 'BOOKMOBI':
+        # only the sections that are dumped get read from disk
+        try:
+            pp = PalmDB(infile)
+        except ValueError:
+            raise dumpHeaderException('invalid file format')
+        if pp.ident != 'BOOKMOBI':
             raise dumpHeaderException('invalid file format')
 
         headers = {}
 
-        pp = PalmDB(mobidata)
-        header = pp.readsection(0)
+        header = pp.loadSection(0)
 
         print "\n\nFirst Header Dump from Section %d" % 0
         hp = HdrParser(header, 0)
@@ -427,13 +402,13 @@ def main(argv=sys.argv):
         # next determine if this is a combo (dual) KF8 mobi file
         # we could examine the metadata for exth_121 in the old mobi header
         # but it is just as quick to scan the palmdb for the boundary section
-        n = pp.getnumsections()
+        n = pp.getNumSections()
         for i in xrange(n):
-            before, after = pp.getsecaddr(i)
+            before, after = pp.sectionRange(i)
             if (after - before) == 8:
-                data = pp.readsection(i)
+                data = pp.loadSection(i)
                 if data == KF8_BOUNDARY:
-                    header = pp.readsection(i+1)
+                    header = pp.loadSection(i+1)
                     print "\n\nMobi Ebook uses the new dual mobi/KF8 file format"
                     print "\nSecond Header Dump from Section %d" % (i+1)
                     hp = HdrParser(header, i+1)
@@ -442,7 +417,7 @@ def main(argv=sys.argv):
                     break
 
         # now dump a basic sector map of the palmdb
-        n = pp.getnumsections()
+        n = pp.getNumSections()
         dtmap = {
             "FLIS": "FLIS",
             "FCIS": "FCIS",
@@ -466,8 +441,8 @@ def main(argv=sys.argv):
         print "    Dec  - Hex : Description"
         print "    ---- - ----  -----------"
         for i in xrange(n):
-            before, after = pp.getsecaddr(i)
-            data = pp.readsection(i)
+            before, after = pp.sectionRange(i)
+            data = pp.loadSection(i)
             dt = data[0:4]
             desc = '' 
             imgtype = imghdr.what(None, data)
@@ -47,13 +47,18 @@
 #  1.32 - removes the SRCS section and its entry, now updates metadata 121 if needed
 #  1.33 - now uses and modifies mobiheader SRCS and CNT
 #  1.34 - added credit for Kevin Hendricks
+#  1.35 - use the shared palmdb reader for the section table
 
-__version__ = '1.34'
+__version__ = '1.35'
 
 import sys
+import os
 import struct
 import binascii
 
+sys.path.append(os.path.join(sys.path[0], 'lib'))
+from palmdb import PalmDB
+
 class Unbuffered:
 	def __init__(self, stream):
 		self.stream = stream
@@ -118,24 +123,22 @@ class SectionStripper:
 			pass
 		return mobiheader
 
-	def __init__(self, datain):
-		if datain[0x3C:0x3C+8] != 'BOOKMOBI':
+	def __init__(self, pdb):
+		if pdb.ident != 'BOOKMOBI':
 			raise StripException("invalid file format")
-		self.num_sections, = struct.unpack('>H', datain[76:78])
+		datain = pdb.data
+		self.num_sections = pdb.num_sections
 		
 		# get mobiheader and check SRCS section number and count
-		offset0, flgval0 = struct.unpack_from('>2L', datain, 78)
-		offset1, flgval1 = struct.unpack_from('>2L', datain, 86)
-		mobiheader = datain[offset0:offset1]
+		mobiheader = pdb.loadSection(0)
 		srcs_secnum, srcs_cnt = struct.unpack_from('>2L', mobiheader, 0xe0)
 		if srcs_secnum == 0xffffffff or srcs_cnt == 0:
 			raise StripException("File doesn't contain the sources section.")
 
 		print "Found SRCS section number %d, and count %d" % (srcs_secnum, srcs_cnt)
 		# find its offset and length
-		next = srcs_secnum + srcs_cnt
-		srcs_offset, flgval = struct.unpack_from('>2L', datain, 78+(srcs_secnum*8))
-		next_offset, flgval = struct.unpack_from('>2L', datain, 78+(next*8))
+		srcs_offset = pdb.offsets[srcs_secnum]
+		next_offset = pdb.sectionRange(srcs_secnum + srcs_cnt - 1)[1]
 		srcs_length = next_offset - srcs_offset
 		if datain[srcs_offset:srcs_offset+4] != 'SRCS':
 			raise StripException("SRCS section num does not point to SRCS.")
@@ -154,16 +157,14 @@ class SectionStripper:
 		# up to the srcs secnum must begin 8 bytes earlier per section removed (each table entry is 8 )
 		delta = -8 * srcs_cnt
 		for i in xrange(srcs_secnum):
-			offset, flgval = struct.unpack_from('>2L', datain, 78+(i*8))
-			offset += delta
-			self.data_file += struct.pack('>L',offset) + struct.pack('>L',flgval)
+			offset = pdb.offsets[i] + delta
+			self.data_file += struct.pack('>L',offset) + struct.pack('>L',pdb.attributes[i])
 			
 		# for every record after the srcs_cnt SRCS records we must start it
 		# earlier by 8*srcs_cnt + the length of the srcs sections themselves)
 		delta = delta - srcs_length
 		for i in xrange(srcs_secnum+srcs_cnt,self.num_sections):
-			offset, flgval = struct.unpack_from('>2L', datain, 78+(i*8))
-			offset += delta
+			offset = pdb.offsets[i] + delta
 			flgval = 2 * (i - srcs_cnt)
 			self.data_file += struct.pack('>L',offset) + struct.pack('>L',flgval)
 
@@ -219,9 +220,12 @@ if __name__ == "__main__":
 	else:
 		infile = sys.argv[1]
 		outfile = sys.argv[2]
-		data_file = file(infile, 'rb').read()
 		try:
-			strippedFile = SectionStripper(data_file)
+			try:
+				pdb = PalmDB(infile)
+			except ValueError:
+				raise StripException("invalid file format")
+			strippedFile = SectionStripper(pdb)
 			file(outfile, 'wb').write(strippedFile.getResult())
 			print "Header Bytes: " + binascii.b2a_hex(strippedFile.getHeader())
 			if len(sys.argv)==4:
@@ -10,6 +10,7 @@
 #  0.02 - Fix issue with size computing
 #  0.03 - Fix issue with some files
 #  0.04 - make stdout self flushing and fix return values
+#  0.05 - use the shared palmdb reader instead of reading the whole file
 
 class Unbuffered:
     def __init__(self, stream):
@@ -25,6 +26,7 @@ sys.stdout=Unbuffered(sys.stdout)
 
 
 import struct
+from palmdb import PalmDB
 
 class BitReader:
     def __init__(self, data):
@@ -90,25 +92,12 @@ class HuffReader:
         self._unpack(BitReader(data))
         return self.r
 
-class Sectionizer:
+class Sectionizer(PalmDB):
     def __init__(self, filename, ident):
-        self.contents = file(filename, 'rb').read()
-        self.header = self.contents[0:72]
-        self.num_sections, = struct.unpack('>H', self.contents[76:78])
-        if self.header[0x3C:0x3C+8] != ident:
+        PalmDB.__init__(self, filename)
+        if self.ident != ident:
+            self.close()
             raise ValueError('Invalid file format')
-        self.sections = []
-        for i in xrange(self.num_sections):
-            offset, a1,a2,a3,a4 = struct.unpack('>LBBBB', self.contents[78+i*8:78+i*8+8])
-            flags, val = a1, a2<<16|a3<<8|a4
-            self.sections.append( (offset, flags, val) )
-    def loadSection(self, section):
-        if section + 1 == self.num_sections:
-            end_off = len(self.contents)
-        else:
-            end_off = self.sections[section + 1][0]
-        off = self.sections[section][0]
-        return self.contents[off:end_off]
 
 
 def getSizeOfTrailingDataEntry(ptr, size):
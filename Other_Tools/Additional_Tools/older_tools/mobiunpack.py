@@ -30,6 +30,7 @@
 #  0.31 - Now supports Print Replica ebooks, outputting PDF and mysterious data sections
 #  0.32 - Now supports NCX file extraction/building.
 #		  Overhauled the structure of mobiunpack to be more class oriented.
+#  0.33 - Use the shared palmdb reader (from ../lib) for the section table.
 
 DEBUG = False
 DEBUG_NCX = False
@@ -58,6 +59,9 @@ sys.stdout=Unbuffered(sys.stdout)
 
 import array, struct, os, re, imghdr
 
+sys.path.append(os.path.join(sys.path[0], os.pardir, 'lib'))
+from palmdb import PalmDB
+
 class unpackException(Exception):
 	pass
 
@@ -184,19 +188,9 @@ class HuffcdicReader:
 			s += slice
 		return s
 
-class Sectionizer:
+class Sectionizer(PalmDB):
 	def __init__(self, filename, perm):
-		self.f = file(filename, perm)
-		header = self.f.read(78)
-		self.ident = header[0x3C:0x3C+8]
-		self.num_sections, = struct.unpack_from('>H', header, 76)
-		sections = self.f.read(self.num_sections*8)
-		self.sections = struct.unpack_from('>%dL' % (self.num_sections*2), sections, 0)[::2] + (0xfffffff, )
-
-	def loadSection(self, section):
-		before, after = self.sections[section:section+2]
-		self.f.seek(before)
-		return self.f.read(after - before)
+		PalmDB.__init__(self, filename)
 
 class mobiUnpack:
 	def __init__(self, files):
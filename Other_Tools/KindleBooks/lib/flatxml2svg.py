@@ -8,21 +8,32 @@ import getopt
 from struct import pack
 from struct import unpack
 
+if 'calibre' in sys.modules:
+    inCalibre = True
+else:
+    inCalibre = False
 
+if inCalibre :
+    from calibre_plugins.k4mobidedrm import convert2xml
+else :
+    import convert2xml
+
+
+# flatxml is the flat xml text of the page or a convert2xml.FlatDoc
 class PParser(object):
     def __init__(self, gd, flatxml, meta_array):
         self.gd = gd
-        self.flatdoc = flatxml.split('\n')
-        self.docSize = len(self.flatdoc)
-        self.temp = []
+        self.doc = convert2xml.getFlatDoc(flatxml)
+        self.docSize = self.doc.size
+        self.scanPage()
 
         self.ph = -1
         self.pw = -1
-        startpos = self.posinDoc('page.h') or self.posinDoc('book.h')
+        startpos = self.found['page.h'] or self.found['book.h']
         for p in startpos:
             (name, argres) = self.lineinDoc(p)
             self.ph = max(self.ph, int(argres))
-        startpos = self.posinDoc('page.w') or self.posinDoc('book.w')
+        startpos = self.found['page.w'] or self.found['book.w']
         for p in startpos:
             (name, argres) = self.lineinDoc(p)
             self.pw = max(self.pw, int(argres))
@@ -32,136 +43,76 @@ class PParser(object):
         if self.pw <= 0:
             self.pw = int(meta_array.get('pageWidth', '8500'))
 
+        self.gx = self.getAllData('info.glyph.x')
+        self.gy = self.getAllData('info.glyph.y')
+        self.gid = self.getAllData('info.glyph.glyphID')
+
+    # tag paths looked for by scanPage
+    scanTags = ('page.h', 'book.h', 'page.w', 'book.w',
+                'info.glyph.x', 'info.glyph.y', 'info.glyph.glyphID',
+                'img', 'img.h', 'img.w', 'img.x', 'img.y', 'img.src')
+
+    # find the lines of all the scanTags in one pass over the page, no
+    # line matches more than one of them
+    def scanPage(self):
+        found = {}
+        for tagpath in self.scanTags:
+            found[tagpath] = []
+        scanTags = self.scanTags
+        for j, name in enumerate(self.doc.names):
+            if name.endswith(scanTags):
+                for tagpath in scanTags:
+                    if name.endswith(tagpath):
+                        found[tagpath].append(j)
+                        break
+        self.found = found
+
+    # the values of all the scanned lines for tagpath, as one list
+    def getAllData(self, tagpath):
         res = []
-        startpos = self.posinDoc('info.glyph.x')
-        for p in startpos:
-            argres = self.getDataatPos('info.glyph.x', p)
-            res.extend(argres)
-        self.gx = res
-
-        res = []
-        startpos = self.posinDoc('info.glyph.y')
-        for p in startpos:
-            argres = self.getDataatPos('info.glyph.y', p)
-            res.extend(argres)
-        self.gy = res
-
-        res = []
-        startpos = self.posinDoc('info.glyph.glyphID')
-        for p in startpos:
-            argres = self.getDataatPos('info.glyph.glyphID', p)
-            res.extend(argres)
-        self.gid = res
+        for p in self.found[tagpath]:
+            res.extend(self.doc.getNumbers(p))
+        return res
 
 
     # return tag at line pos in document
     def lineinDoc(self, pos) :
         if (pos >= 0) and (pos < self.docSize) :
-            item = self.flatdoc[pos]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=',1)
-            else :
-                name = item
-                argres = ''
+            (name, argres) = self.doc.line(pos)
         return name, argres
 
     # find tag in doc if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
-        result = None
-        if end == -1 :
-            end = self.docSize
-        else:
-            end = min(self.docSize, end)
-        foundat = -1
-        for j in xrange(pos, end):
-            item = self.flatdoc[j]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=',1)
-            else :
-                name = item
-                argres = ''
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
-        return foundat, result
+        return self.doc.find(tagpath, pos, end)
 
     # return list of start positions for the tagpath
     def posinDoc(self, tagpath):
-        startpos = []
-        pos = 0
-        res = ""
-        while res != None :
-            (foundpos, res) = self.findinDoc(tagpath, pos, -1)
-            if res != None :
-                startpos.append(foundpos)
-            pos = foundpos + 1
-        return startpos
+        return list(self.doc.positions(tagpath))
 
     def getData(self, path):
         result = None
-        cnt = len(self.flatdoc)
-        for j in xrange(cnt):
-            item = self.flatdoc[j]
-            if item.find('=') >= 0:
-                (name, argt) = item.split('=')
-                argres = argt.split('|')
-            else:
-                name = item
-                argres = []
-            if (name.endswith(path)):
-                result = argres
-                break
-        if (len(argres) > 0) :
-            for j in xrange(0,len(argres)):
-                argres[j] = int(argres[j])
+        (foundat, argt) = self.findinDoc(path, 0, -1)
+        if foundat >= 0:
+            result = list(self.doc.getNumbers(foundat))
         return result
 
     def getDataatPos(self, path, pos):
         result = None
-        item = self.flatdoc[pos]
-        if item.find('=') >= 0:
-            (name, argt) = item.split('=')
-            argres = argt.split('|')
-        else:
-            name = item
-            argres = []
-        if (len(argres) > 0) :
-            for j in xrange(0,len(argres)):
-                argres[j] = int(argres[j])
+        (name, argt) = self.doc.line(pos)
         if (name.endswith(path)):
-            result = argres
-        return result
-
-    def getDataTemp(self, path):
-        result = None
-        cnt = len(self.temp)
-        for j in xrange(cnt):
-            item = self.temp[j]
-            if item.find('=') >= 0:
-                (name, argt) = item.split('=')
-                argres = argt.split('|')
-            else:
-                name = item
-                argres = []
-            if (name.endswith(path)):
-                result = argres
-                self.temp.pop(j)
-                break
-        if (len(argres) > 0) :
-            for j in xrange(0,len(argres)):
-                argres[j] = int(argres[j])
+            result = list(self.doc.getNumbers(pos))
         return result
 
+    # the n-th img tag goes with the n-th img.h, img.w, ... found
     def getImages(self):
         result = []
-        self.temp = self.flatdoc
-        while (self.getDataTemp('img') != None):
-            h = self.getDataTemp('img.h')[0]
-            w = self.getDataTemp('img.w')[0]
-            x = self.getDataTemp('img.x')[0]
-            y = self.getDataTemp('img.y')[0]
-            src = self.getDataTemp('img.src')[0]
+        found = self.found
+        for j in xrange(len(found['img'])):
+            h = self.doc.getNumbers(found['img.h'][j])[0]
+            w = self.doc.getNumbers(found['img.w'][j])[0]
+            x = self.doc.getNumbers(found['img.x'][j])[0]
+            y = self.doc.getNumbers(found['img.y'][j])[0]
+            src = self.doc.getNumbers(found['img.src'][j])[0]
             result.append('<image xlink:href="../img/img%04d.jpg" x="%d" y="%d" width="%d" height="%d" />\n' % (src, x, y, w, h))
         return result
 
@@ -173,10 +124,9 @@ class PParser(object):
                 glyphs.append(j)
             glyphs.sort()
             for gid in glyphs:
-                id='id="gl%d"' % gid
-                path = self.gd.lookup(id)
+                path = self.gd.lookup(gid)
                 if path:
-                    result.append(id + ' ' + path)
+                    result.append('id="gl%d" ' % gid + path)
         return result
 
 
@@ -247,3 +197,47 @@ def convert2SVG(gdict, flat_xml, pageid, previd, nextid, svgDir, raw, meta_array
         mlst.append('</body>\n')
         mlst.append('</html>\n')
     return "".join(mlst)
+
+
+# flat xml of a page with nimages images and nglyphs glyphs
+def makeTestPage(nimages, nglyphs):
+    flst = []
+    flst.append('info.glyph.x=' + '|'.join(['%d' % ((i * 7919) % 8000) for i in xrange(nglyphs)]))
+    flst.append('info.glyph.y=' + '|'.join(['%d' % ((i * 104729) % 11000) for i in xrange(nglyphs)]))
+    flst.append('info.glyph.glyphID=' + '|'.join(['%d' % (i % 700) for i in xrange(nglyphs)]))
+    flst.append('page')
+    flst.append('page.type=text')
+    flst.append('page.h=11000')
+    flst.append('page.w=8500')
+    for i in xrange(nimages):
+        flst.append('page.region')
+        flst.append('page.region.type=graphic')
+        flst.append('page.region.img')
+        flst.append('page.region.img.x=%d' % (i % 80 * 100))
+        flst.append('page.region.img.y=%d' % (i / 80 * 100))
+        flst.append('page.region.img.h=100')
+        flst.append('page.region.img.w=100')
+        flst.append('page.region.img.src=%d' % i)
+    flst.append('')
+    return '\n'.join(flst)
+
+# time the svg conversion of image dense pages
+def benchmark(count=20):
+    import time
+    import genbook
+    gd = genbook.GlyphDict()
+    for i in xrange(700):
+        gd.addGlyph(i, 'M 0 0 C 10 10 20 20 30 30 z', 30, 30)
+    meta_array = {'Title' : 'Benchmark', 'Authors' : 'None', 'fontSize' : '135'}
+    for nimages, nglyphs in ((100, 4000), (1000, 4000), (5000, 1000)):
+        flat_xml = makeTestPage(nimages, nglyphs)
+        start = time.time()
+        for i in xrange(count):
+            convert2SVG(gd, flat_xml, 1, None, 2, '.', 0, meta_array, 1440.0)
+        elapsed = max(time.time() - start, 1e-6)
+        print '%5d images, %5d glyphs: %.1f ms per page' % (nimages, nglyphs, elapsed * 1000 / count)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(benchmark())
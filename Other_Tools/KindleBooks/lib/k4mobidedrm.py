@@ -77,7 +77,7 @@ def cleanup_name(name):
     one = one.replace('_',' ')
     return one
 
-def decryptBook(infile, outdir, k4, kInfoFiles, serials, pids):
+def decryptBook(infile, outdir, k4, kInfoFiles, serials, pids, jobs=1):
     global buildXML
 
 
@@ -130,9 +130,23 @@ def decryptBook(infile, outdir, k4, kInfoFiles, serials, pids):
 
     print "Found {1:d} keys to try after {0:.1f} seconds".format(time.time()-starttime, len(pids))
 
+    # Mobi books are decrypted straight to disk. The final name depends on
+    # whether the book turns out to be Print Replica, so use a temporary name.
+    tmpfile = os.path.join(outdir, outfilename + '_nodrm' + '.tmp')
 
     try:
-        mb.processBook(pids)
+        if mobi:
+            outf = file(tmpfile, 'wb')
+            try:
+                mb.processBookTo(outf, pids, jobs)
+            except:
+                outf.close()
+                mb.cleanup()
+                os.remove(tmpfile)
+                raise
+            outf.close()
+        else:
+            mb.processBook(pids, jobs)
 
     except mobidedrm.DrmException, e:
         print >>sys.stderr, ('K4MobiDeDrm v%(__version__)s\n' % globals()) + "Error: " + str(e) + "\nDRM Removal Failed.\n"
@@ -156,7 +170,10 @@ def decryptBook(infile, outdir, k4, kInfoFiles, serials, pids):
             outfile = os.path.join(outdir, outfilename + '_nodrm' + '.azw3')
         else:
             outfile = os.path.join(outdir, outfilename + '_nodrm' + '.mobi')
-        mb.getMobiFile(outfile)
+        mb.cleanup()
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        os.rename(tmpfile, outfile)
         print "Saved decrypted book {1:s} after {0:.1f} seconds".format(time.time()-starttime, outfilename + '_nodrm')
         return 0
 
@@ -183,7 +200,9 @@ def decryptBook(infile, outdir, k4, kInfoFiles, serials, pids):
 def usage(progname):
     print "Removes DRM protection from K4PC/M, Kindle, Mobi and Topaz ebooks"
     print "Usage:"
-    print "    %s [-k <kindle.info>] [-p <pidnums>] [-s <kindleSerialNumbers>] <infile> <outdir>  " % progname
+    print "    %s [-k <kindle.info>] [-p <pidnums>] [-s <kindleSerialNumbers>] [-j <jobs>] <infile> <outdir>  " % progname
+    print "Use --jobs (-j) to decrypt, or to render Topaz pages, using several processes at once"
+    print "Use --pidcache to keep values decoded from kindle.info files in a local cache"
 
 #
 # Main
@@ -195,12 +214,13 @@ def main(argv=sys.argv):
     kInfoFiles = []
     serials = []
     pids = []
+    jobs = 1
 
     print ('K4MobiDeDrm v%(__version__)s '
            'provided by the work of many including DiapDealer, SomeUpdates, IHeartCabbages, CMBDTC, Skindle, DarkReverser, ApprenticeAlf, etc .' % globals())
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "k:p:s:")
+        opts, args = getopt.getopt(sys.argv[1:], "k:p:s:j:", ["jobs=", "pidcache"])
     except getopt.GetoptError, err:
         print str(err)
         usage(progname)
@@ -222,6 +242,13 @@ def main(argv=sys.argv):
             if a == None :
                 raise DrmException("Invalid parameter for -s")
             serials = a.split(',')
+        if o in ("-j", "--jobs"):
+            try:
+                jobs = int(a)
+            except ValueError:
+                raise DrmException("Invalid parameter for --jobs")
+        if o == "--pidcache":
+            kgenpids.usePidCache = True
 
     # try with built in Kindle Info files
     k4 = True
@@ -230,7 +257,7 @@ def main(argv=sys.argv):
         kInfoFiles = None
     infile = args[0]
     outdir = args[1]
-    return decryptBook(infile, outdir, k4, kInfoFiles, serials, pids)
+    return decryptBook(infile, outdir, k4, kInfoFiles, serials, pids, jobs)
 
 
 if __name__ == '__main__':
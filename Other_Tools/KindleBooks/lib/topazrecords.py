@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# topazrecords.py
+# Store for the decrypted and decompressed payload records of a Topaz
+# book, looked up by record name and index.
+#
+# topazextract fills it and genbook reads the records back from it, so
+# the pieces of a book no longer have to go through a temporary
+# directory. Records are kept in memory unless a spill directory is
+# given, in which case they are written there using the layout of the
+# old extraction directory (dict0000.dat, page/page0000.dat,
+# img/img0000.jpg, ...). A directory with that layout can be opened
+# again as a store.
+#
+# Changelog
+#  1.00 - Initial version
+
+__version__ = '1.00'
+
+import os
+import re
+import shutil
+
+# records kept in their own subdirectory when written to disk
+subdirs = {
+    'img'    : 'img',
+    'color'  : 'color_img',
+    'page'   : 'page',
+    'glyphs' : 'glyphs',
+}
+
+# file extension for each record name, '.dat' if not listed
+extensions = {
+    'img'   : '.jpg',
+    'color' : '.jpg',
+}
+
+recordFileName = re.compile(r'^(\D+)(\d{4,})(\.\w+)$')
+
+class TopazRecords(object):
+    def __init__(self, spilldir=None):
+        self.spilldir = spilldir
+        # name -> {index : data}, data is None for records on disk
+        self.records = {}
+        if spilldir is not None:
+            self.scanDirectory()
+
+    # file name used for a record, e.g. page0012.dat
+    def getFileName(self, name, index):
+        return '%s%04d%s' % (name, index, extensions.get(name, '.dat'))
+
+    def getFilePath(self, name, index):
+        path = self.spilldir
+        if name in subdirs:
+            path = os.path.join(path, subdirs[name])
+        return os.path.join(path, self.getFileName(name, index))
+
+    # pick up the records already in the spill directory
+    def scanDirectory(self):
+        for dirname in [''] + subdirs.values():
+            path = os.path.join(self.spilldir, dirname)
+            if not os.path.isdir(path):
+                continue
+            for filename in os.listdir(path):
+                m = recordFileName.match(filename)
+                if m is None:
+                    continue
+                name = m.group(1)
+                index = int(m.group(2))
+                if subdirs.get(name, '') == dirname and filename == self.getFileName(name, index):
+                    self.records.setdefault(name, {})[index] = None
+
+    def addRecord(self, name, index, data):
+        if self.spilldir is not None:
+            path = self.getFilePath(name, index)
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            file(path, 'wb').write(data)
+            data = None
+        self.records.setdefault(name, {})[index] = data
+
+    # Make record name/index the record srcname/index, without copying
+    # it. In memory both names refer to the same string, on disk the
+    # file is hard linked, or moved where links are not supported (the
+    # srcname record is then dropped from the store).
+    def linkRecord(self, name, index, srcname):
+        data = self.records.get(srcname, {}).get(index, '')
+        if data is None:
+            path = self.getFilePath(name, index)
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            self.linkFile(self.getFilePath(srcname, index), path, srcname, index)
+        self.records.setdefault(name, {})[index] = data
+
+    # Write record name/index to path outside the store, a record on disk
+    # is hard linked (or copied) rather than read and written again.
+    def exportRecord(self, name, index, path):
+        data = self.records.get(name, {}).get(index, '')
+        if data is None:
+            self.linkFile(self.getFilePath(name, index), path)
+        else:
+            file(path, 'wb').write(data)
+
+    # link src to dst, replacing dst. Without link support the file is
+    # moved if it belongs to record name/index, else copied.
+    def linkFile(self, src, dst, name=None, index=None):
+        if os.path.exists(dst):
+            if os.path.exists(src) and os.path.samefile(src, dst):
+                return
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+            return
+        except (AttributeError, OSError):
+            pass
+        if name is not None:
+            os.rename(src, dst)
+            del self.records[name][index]
+        else:
+            shutil.copyfile(src, dst)
+
+    def hasRecord(self, name, index):
+        return index in self.records.get(name, {})
+
+    # sorted indices of the records with this name
+    def getIndices(self, name):
+        return sorted(self.records.get(name, {}).keys())
+
+    def getCount(self, name):
+        return len(self.records.get(name, {}))
+
+    # missing records read as empty strings
+    def getRecord(self, name, index):
+        data = self.records.get(name, {}).get(index, '')
+        if data is None:
+            data = file(self.getFilePath(name, index), 'rb').read()
+        return data
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# zipwriter.py
+# Write zip archive members that were compressed ahead of time.
+#
+# A member is compressed once into a ZipMember and can then be written
+# to any number of archives. Members can be compressed on several
+# threads (zlib lets the other threads run while it works), and data
+# that is already in raw deflate form can be written as it is, given
+# its CRC and uncompressed size.
+#
+# Changelog
+#  1.00 - Initial version
+
+__version__ = '1.00'
+
+import time
+import zlib
+import struct
+import zipfile
+import itertools
+from zipfile import ZIP_STORED, ZIP_DEFLATED
+
+# members with these extensions hold data that is already compressed,
+# deflating it again only costs time
+storedExtensions = ('.jpg', '.jpeg', '.png', '.gif', '.mp3', '.mp4', '.m4a', '.zip')
+
+# number of members handed to a thread at a time
+THREAD_BATCH = 4
+
+def getCompressType(name):
+    if name.lower().endswith(storedExtensions):
+        return ZIP_STORED
+    return ZIP_DEFLATED
+
+# raw deflate stream of data, as zipfile makes it
+def deflate(data):
+    co = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return co.compress(data) + co.flush()
+
+
+# a zip member ready to be written: data is the stored or deflated
+# bytes, CRC and file_size describe the uncompressed contents
+class ZipMember(object):
+    def __init__(self, name, compress_type, CRC, file_size, data):
+        self.name = name
+        self.compress_type = compress_type
+        self.CRC = CRC
+        self.file_size = file_size
+        self.data = data
+
+# compress_type None picks one from the member name
+def compressMember(name, data, compress_type=None):
+    if compress_type is None:
+        compress_type = getCompressType(name)
+    crc = zlib.crc32(data) & 0xffffffff
+    file_size = len(data)
+    if compress_type == ZIP_DEFLATED:
+        data = deflate(data)
+    return ZipMember(name, compress_type, crc, file_size, data)
+
+def compressMemberArgs(args):
+    return compressMember(*args)
+
+# Yield a ZipMember for each (name, data) or (name, data, compress_type)
+# in members, in order. With threads > 1 the members are compressed by a
+# pool of threads, only a few batches are read ahead.
+def compressMembers(members, threads=1):
+    if threads < 2:
+        for args in members:
+            yield compressMember(*args)
+        return
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(threads)
+    members = iter(members)
+    try:
+        while True:
+            chunk = list(itertools.islice(members, threads * THREAD_BATCH))
+            if len(chunk) == 0:
+                break
+            for member in pool.imap(compressMemberArgs, chunk):
+                yield member
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+# Write member to the open ZipFile zip, the same way ZipFile.writestr
+# would have written its uncompressed contents. zinfo can give the
+# member's ZipInfo, its sizes, CRC and compression are filled in here.
+def writeMember(zip, member, zinfo=None):
+    if zinfo is None:
+        zinfo = zipfile.ZipInfo(filename=member.name, date_time=time.localtime(time.time())[:6])
+        zinfo.external_attr = 0600 << 16
+    if not zip.fp:
+        raise RuntimeError("Attempt to write to ZIP archive that was already closed")
+    zinfo.compress_type = member.compress_type
+    zinfo.file_size = member.file_size
+    zinfo.compress_size = len(member.data)
+    zinfo.CRC = member.CRC
+    zinfo.header_offset = zip.fp.tell()
+    zip._writecheck(zinfo)
+    zip._didModify = True
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    if zip64:
+        if not zip._allowZip64:
+            raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+        zip.fp.write(zinfo.FileHeader(zip64))
+    else:
+        zip.fp.write(zinfo.FileHeader())
+    zip.fp.write(member.data)
+    if zinfo.flag_bits & 0x08:
+        # CRC and file sizes after the file data
+        fmt = '<LLQQ' if zip64 else '<LLLL'
+        zip.fp.write(struct.pack(fmt, zipfile._DD_SIGNATURE, zinfo.CRC,
+                                 zinfo.compress_size, zinfo.file_size))
+    zip.fp.flush()
+    zip.filelist.append(zinfo)
+    zip.NameToInfo[zinfo.filename] = zinfo
@@ -823,6 +823,30 @@ class ZipFile:
 
         return info
 
+    def repairNames(self):
+        """Rename the members whose local file header gives a different
+        name than the central directory to that local name, so they can
+        be read.  Returns the number of members renamed."""
+        if not self.fp:
+            raise RuntimeError, \
+                  "Attempt to read ZIP archive that was already closed"
+        renamed = 0
+        for zinfo in self.filelist:
+            self.fp.seek(zinfo.header_offset, 0)
+            fheader = self.fp.read(sizeFileHeader)
+            if fheader[0:4] != stringFileHeader:
+                raise BadZipfile, "Bad magic number for file header"
+            fheader = struct.unpack(structFileHeader, fheader)
+            fname = self.fp.read(fheader[_FH_FILENAME_LENGTH])
+            if fname != zinfo.orig_filename:
+                if self.NameToInfo.get(zinfo.filename) is zinfo:
+                    del self.NameToInfo[zinfo.filename]
+                zinfo.orig_filename = zinfo.filename = fname
+                zinfo.filename = zinfo._decodeFilename()
+                self.NameToInfo[zinfo.filename] = zinfo
+                renamed += 1
+        return renamed
+
     def setpassword(self, pwd):
         """Set default password for encrypted files."""
         self.pwd = pwd
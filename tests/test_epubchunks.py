@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Checks the CRC and sizes encodeChunks finds for deflate streams that
+# are written as they are, run with: python tests/test_epubchunks.py
+
+import os
+import sys
+import zlib
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'DeDRM_Applications', 'Windows', 'DeDRM_5.4.1', 'DeDRM_lib', 'lib'))
+
+import ineptepub
+import ignobleepub
+
+def deflate(data):
+    co = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return co.compress(data) + co.flush()
+
+def pieces(data, size):
+    return [data[i:i+size] for i in xrange(0, len(data), size)]
+
+class EncodeChunksTest(unittest.TestCase):
+
+    def check(self, module, data, piecesize=None):
+        stream = deflate(data)
+        chunks = [stream]
+        if piecesize:
+            chunks = pieces(stream, piecesize)
+        zinfo = module.memberInfo('x')
+        written = ''.join(module.encodeChunks(zinfo, chunks, True))
+        self.assertEqual(written, stream)
+        self.assertEqual(zinfo.file_size, len(data))
+        self.assertEqual(zinfo.CRC, zlib.crc32(data) & 0xffffffff)
+        self.assertEqual(zinfo.compress_size, len(stream))
+
+    def checkSizes(self, module):
+        size = module.CHUNK_SIZE
+        rnd = random.Random(7)
+        text = ''.join(rnd.choice('abcdefgh ') for i in xrange(3 * size))
+        for n in (size - 1, size, size + 1, size + 100, 2 * size + 16):
+            self.check(module, 'a' * n)
+            self.check(module, text[:n])
+            self.check(module, text[:n], 4096)
+
+    def test_inept_past_chunk_size(self):
+        self.checkSizes(ineptepub)
+
+    def test_ignoble_past_chunk_size(self):
+        self.checkSizes(ignobleepub)
+
+    def test_incomplete_stream(self):
+        stream = deflate('a' * 1000)[:-4]
+        zinfo = ineptepub.memberInfo('x')
+        self.assertRaises(zlib.error, list, ineptepub.encodeChunks(zinfo, [stream], True))
+
+
+if __name__ == '__main__':
+    unittest.main()